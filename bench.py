@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+#coding:utf8
+"""
+Benchmarks for id3.py
+
+Memory held per parsed frame
+
+    python bench.py memory --frames 200000
+
+Throughput, latency percentiles and peak memory of parse, dump, save
+and remove over a synthetic corpus, one JSON record per line
+
+    python bench.py corpus --count 500 --profile v23-many --profile apic
+
+Unsynchronisation decode and encode over a large APIC payload
+
+    python bench.py unsync --picture-mb 8
+
+Synthetic corpus only, for other tools
+
+    python bench.py generate /tmp/corpus --count 500
+"""
+import argparse
+import collections
+import gc
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import timeit
+
+import id3
+from id3 import Tag
+
+
+def buildFrame(frameID, payload, flags=0, versionMajor=3):
+    size = len(payload)
+    if versionMajor == 4:
+        size = Tag.syncsafeEncode(size)
+    return frameID + struct.pack("!LH", size, flags) + payload
+
+
+def buildText(text, encoding='UTF-16'):
+    idx = id3.ENCODINGS.index(encoding)
+    return chr(idx) + (text + u'\x00').encode(encoding)
+
+
+def buildTag(frames, versionMajor=3, padding=0):
+    body = ''.join(frames) + '\x00' * padding
+    return Tag.FILE_ID_V2X + chr(versionMajor) + chr(0) + chr(0) + \
+        struct.pack("!L", Tag.syncsafeEncode(len(body))) + body
+
+
+def sampleFrames(encoding='UTF-16'):
+    """ frames of a typical album track """
+    return [
+        buildFrame("TIT2", buildText(u'Some Track Title', encoding)),
+        buildFrame("TPE1", buildText(u'Some Artist', encoding)),
+        buildFrame("TALB", buildText(u'Some Album Name', encoding)),
+        buildFrame("TYER", buildText(u'2001', encoding)),
+        buildFrame("TRCK", buildText(u'3/12', encoding)),
+        buildFrame("TCON", buildText(u'Rock', encoding)),
+        buildFrame("TPOS", buildText(u'1/1', encoding)),
+        buildFrame("TPE2", buildText(u'Some Artist', encoding)),
+        buildFrame("COMM", chr(0) + 'eng' + 'short\x00' + 'a longer comment on this track'),
+        buildFrame("TXXX", chr(0) + 'CATALOG\x00' + 'ABC-12345'),
+        buildFrame("PRIV", 'WM/MediaClassPrimaryID\x00' + '\x01' * 16),
+        buildFrame("USLT", chr(0) + 'eng' + 'lyrics\x00' + 'la la la ' * 20),
+    ]
+
+
+def buildV1Tag(title, artist, album, year, comment, track, genre):
+    return Tag.FILE_ID_V1X + title[:30].ljust(30, '\x00') + artist[:30].ljust(30, '\x00') + \
+        album[:30].ljust(30, '\x00') + year[:4].ljust(4, '\x00') + \
+        comment[:28].ljust(28, '\x00') + '\x00' + chr(track) + chr(genre)
+
+
+def buildAudio(rnd, size):
+    """ MPEG frame sync followed by random bytes """
+    size = max(size - 2, 1)
+    return '\xff\xfb' + ('%x' % rnd.getrandbits(size * 8)).zfill(size * 2).decode('hex')
+
+
+def buildPicture(rnd, size):
+    payload = chr(0) + 'image/jpeg\x00' + chr(3) + 'cover\x00'
+    return buildFrame("APIC", payload + '\xff\xd8' + buildAudio(rnd, size))
+
+
+def buildManyFrames(rnd, count, encoding, versionMajor):
+    frames = []
+    for i in xrange(count):
+        frames.append(buildFrame("TXXX", chr(id3.ENCODINGS.index(encoding)) +
+                                 (u'KEY%d\x00value %d' % (i, rnd.randint(0, 1 << 20))).encode(encoding),
+                                 versionMajor=versionMajor))
+    return frames
+
+
+# profile name -> (versionX, versionMajor, encoding, extra frames, picture bytes, padding)
+PROFILES = collections.OrderedDict([
+    ("v1", (1, 1, None, 0, 0, 0)),
+    ("v23-few", (2, 3, 'UTF-16', 0, 0, 0)),
+    ("v23-many", (2, 3, 'UTF-16', 200, 0, 0)),
+    ("v24-utf8", (2, 4, 'UTF-8', 20, 0, 0)),
+    ("apic", (2, 3, 'UTF-16', 0, 1024 * 1024, 0)),
+    ("padding", (2, 3, 'UTF-16', 0, 0, 64 * 1024)),
+])
+
+
+def buildFile(rnd, profile, audioSize):
+    versionX, versionMajor, encoding, extra, pictureSize, padding = PROFILES[profile]
+    audio = buildAudio(rnd, audioSize)
+
+    if versionX == 1:
+        return audio + buildV1Tag('Title %d' % rnd.randint(0, 1 << 20), 'Artist', 'Album', '2001',
+                                  'comment', rnd.randint(1, 20), rnd.randint(0, 79))
+
+    if versionMajor == 4:
+        frames = [buildFrame(f[:4], f[10:], versionMajor=4) for f in sampleFrames(encoding)[:8]]
+    else:
+        frames = sampleFrames(encoding)
+    frames.extend(buildManyFrames(rnd, extra, encoding, versionMajor))
+    if pictureSize:
+        frames.append(buildPicture(rnd, pictureSize))
+    return buildTag(frames, versionMajor=versionMajor, padding=padding) + audio
+
+
+def generateCorpus(dirpath, count, profiles, audioSize=64 * 1024, seed=0):
+    """ write count files per profile under dirpath/profile, same seed gives same corpus """
+    rnd = random.Random(seed)
+    corpus = collections.OrderedDict()
+    for profile in profiles:
+        dirProfile = os.path.join(dirpath, profile)
+        if not os.path.isdir(dirProfile):
+            os.makedirs(dirProfile)
+
+        filepaths = []
+        for i in xrange(count):
+            filepath = os.path.join(dirProfile, '%06d.mp3' % i)
+            with open(filepath, 'wb') as f:
+                f.write(buildFile(rnd, profile, audioSize))
+            filepaths.append(filepath)
+        corpus[profile] = filepaths
+    return corpus
+
+
+def percentile(values, p):
+    """ nearest-rank percentile of sorted values """
+    if not values:
+        return None
+    idx = int(round(p / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+
+def timeOperation(name, filepaths, operation):
+    """ run operation over filepaths in a forked child, returns throughput, latency percentiles and peak RSS """
+    readFd, writeFd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(readFd)
+        status = 0
+        try:
+            try:
+                result = runOperation(name, filepaths, operation)
+            except Exception as e:
+                result = {"name": name, "error": repr(e)}
+                status = 1
+            with os.fdopen(writeFd, 'wb') as f:
+                json.dump(result, f)
+        finally:
+            os._exit(status)
+
+    os.close(writeFd)
+    with os.fdopen(readFd, 'rb') as f:
+        result = json.load(f)
+    os.waitpid(pid, 0)
+    if "error" in result:
+        raise RuntimeError("%s failed: %s" % (name, result["error"]))
+    return result
+
+
+def runOperation(name, filepaths, operation):
+    """ time operation over filepaths, peak RSS is that of the calling process """
+    gc.collect()
+    rssBefore = maxRSS()
+    latencies = []
+    nbytes = 0
+    started = timeit.default_timer()
+    for filepath in filepaths:
+        t = timeit.default_timer()
+        operation(filepath)
+        latencies.append(timeit.default_timer() - t)
+        nbytes += os.path.getsize(filepath)
+    elapsed = timeit.default_timer() - started
+    rssAfter = maxRSS()
+
+    latencies.sort()
+    return {
+        "name": name,
+        "files": len(filepaths),
+        "bytes": nbytes,
+        "seconds": elapsed,
+        "filesPerSecond": len(filepaths) / elapsed if elapsed else None,
+        "mbPerSecond": nbytes / 1024.0 / 1024.0 / elapsed if elapsed else None,
+        "latencyP50": percentile(latencies, 50),
+        "latencyP90": percentile(latencies, 90),
+        "latencyP99": percentile(latencies, 99),
+        "latencyMax": latencies[-1] if latencies else None,
+        "maxRSSBytes": rssAfter,
+        "maxRSSGrowthBytes": rssAfter - rssBefore,
+    }
+
+
+def parseV2(filepath):
+    with open(filepath, 'rb') as f:
+        return Tag.parseV2FromFile(fileobj=f)
+
+
+def corpusOperations(tmpdir):
+    """ operation name -> callable of filepath """
+    def dumps(filepath):
+        tag = Tag.parseFromFilepath(filepath=filepath)
+        return tag.dumps(version=tag.version)
+
+    def saveAs(filepath):
+        tag = Tag.parseFromFilepath(filepath=filepath)
+        tag.saveAs(filepath=os.path.join(tmpdir, 'saveAs.id3'), version=tag.version)
+
+    def remove(filepath):
+        return Tag.remove(filepath)
+
+    return collections.OrderedDict([
+        ("parseFromFilepath", lambda filepath: Tag.parseFromFilepath(filepath=filepath)),
+        ("parseV2FromFile", parseV2),
+        ("dumps", dumps),
+        ("saveAs", saveAs),
+        ("remove", remove),
+    ])
+
+
+def benchCorpus(count, profiles, operations=None, audioSize=64 * 1024, seed=0, dirpath=None):
+    """ yield one result per (profile, operation) """
+    tmpdir = tempfile.mkdtemp(prefix='id3-bench-')
+    try:
+        corpus = generateCorpus(dirpath or tmpdir, count, profiles, audioSize=audioSize, seed=seed)
+        allOperations = corpusOperations(tmpdir)
+        for profile, filepaths in corpus.iteritems():
+            for name, operation in allOperations.iteritems():
+                if operations and name not in operations:
+                    continue
+                if name == "parseV2FromFile" and PROFILES[profile][0] != 2:
+                    continue
+
+                result = timeOperation(name, filepaths, operation)
+                result["profile"] = profile
+                result["seed"] = seed
+                yield result
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def timeCall(func, repeat):
+    """ best of repeat runs in seconds, with the last result """
+    best = None
+    for _ in xrange(repeat):
+        started = timeit.default_timer()
+        result = func()
+        elapsed = timeit.default_timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchUnsync(pictureSize, repeat=5, seed=0):
+    """ yield one result per operation over a tag holding an APIC of pictureSize bytes """
+    rnd = random.Random(seed)
+    # JPEG-like, $FF markers are frequent
+    picture = buildAudio(rnd, pictureSize).replace('\x10', '\xff').replace('\x20', '\xe0')
+    payload = chr(0) + 'image/jpeg\x00' + chr(3) + 'cover\x00' + picture
+
+    encoded = Tag.unsyncEncode(payload)
+    assert Tag.unsyncDecode(encoded) == payload
+
+    tag = Tag.parseV2FromBuffer(buildTag(sampleFrames() + [buildFrame("APIC", payload)]))
+    rawTags = {3: tag.dumps(version=(2, 3, 0), unsynchronise=True)}
+    for f in tag.frames:
+        f.versionMajor = 4
+    rawTags[4] = tag.dumps(version=(2, 4, 0), unsynchronise=True)
+    for f in tag.frames:
+        f.versionMajor = 3
+
+    for versionMajor in (3, 4):
+        assert Tag.parseV2FromBuffer(rawTags[versionMajor]).frames[-1].data == picture
+
+    operations = [
+        ("unsyncEncode", len(payload), lambda: Tag.unsyncEncode(payload)),
+        ("unsyncDecode", len(encoded), lambda: Tag.unsyncDecode(encoded)),
+        ("parseV2FromBuffer-v2.3", len(rawTags[3]), lambda: Tag.parseV2FromBuffer(rawTags[3]).frames[-1].data),
+        ("parseV2FromBuffer-v2.4", len(rawTags[4]), lambda: Tag.parseV2FromBuffer(rawTags[4]).frames[-1].data),
+        ("dumps-v2.3", len(rawTags[3]), lambda: tag.dumps(version=(2, 3, 0), unsynchronise=True)),
+    ]
+    for name, nbytes, func in operations:
+        seconds, _ = timeCall(func, repeat)
+        yield {
+            "name": name,
+            "bytes": nbytes,
+            "inserted": len(encoded) - len(payload),
+            "seconds": seconds,
+            "mbPerSecond": nbytes / 1024.0 / 1024.0 / seconds if seconds else None,
+        }
+
+
+def frameSize(frame):
+    """ bytes held by frame itself, its attribute dict and its string attributes """
+    size = sys.getsizeof(frame)
+
+    values = []
+    if hasattr(frame, '__dict__'):
+        size += sys.getsizeof(frame.__dict__)
+        values.extend(frame.__dict__.values())
+
+    for cls in type(frame).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if hasattr(frame, name):
+                values.append(getattr(frame, name))
+
+    for value in values:
+        if isinstance(value, basestring):
+            size += sys.getsizeof(value)
+    return size
+
+
+def maxRSS():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchMemory(count, keepRawData=True):
+    id3.Frame.KEEP_RAW_DATA = keepRawData
+
+    rawTag = buildTag(sampleFrames())
+
+    gc.collect()
+    rssBefore = maxRSS()
+
+    tags = []
+    frames = 0
+    while frames < count:
+        tag = Tag.parseV2FromBuffer(rawTag)
+        tags.append(tag)
+        frames += len(tag.frames)
+
+    gc.collect()
+    rssAfter = maxRSS()
+
+    sizes = [frameSize(f) for f in tags[0].frames]
+
+    return {
+        "name": "memory",
+        "keepRawData": keepRawData,
+        "frames": frames,
+        "bytesPerFrame": sum(sizes) / float(len(sizes)),
+        "rssBytesPerFrame": (rssAfter - rssBefore) / float(frames),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="id3.py benchmarks")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parserMemory = subparsers.add_parser("memory", help="memory held per parsed frame")
+    parserMemory.add_argument('--frames', type=int, default=200000)
+    parserMemory.add_argument('--no-raw-data', action="store_true", help="do not retain raw frame payloads")
+
+    parserCorpus = subparsers.add_parser("corpus", help="time operations over a synthetic corpus")
+    parserCorpus.add_argument('--count', type=int, default=200, help="files per profile")
+    parserCorpus.add_argument('--profile', action="append", choices=PROFILES.keys(), help="defaults to all")
+    parserCorpus.add_argument('--op', action="append", help="operation to time, defaults to all")
+    parserCorpus.add_argument('--audio-kb', type=int, default=64)
+    parserCorpus.add_argument('--seed', type=int, default=0)
+
+    parserUnsync = subparsers.add_parser("unsync", help="unsynchronisation over a large APIC payload")
+    parserUnsync.add_argument('--picture-mb', type=int, default=8)
+    parserUnsync.add_argument('--repeat', type=int, default=5)
+
+    parserGenerate = subparsers.add_parser("generate", help="write a synthetic corpus")
+    parserGenerate.add_argument('dir')
+    parserGenerate.add_argument('--count', type=int, default=200, help="files per profile")
+    parserGenerate.add_argument('--profile', action="append", choices=PROFILES.keys(), help="defaults to all")
+    parserGenerate.add_argument('--audio-kb', type=int, default=64)
+    parserGenerate.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == "memory":
+        result = benchMemory(count=args.frames, keepRawData=not args.no_raw_data)
+        print json.dumps(result, sort_keys=True)
+    elif args.command == "corpus":
+        id3.logger.setLevel(logging.WARNING)
+        for result in benchCorpus(count=args.count, profiles=args.profile or PROFILES.keys(), operations=args.op,
+                                  audioSize=args.audio_kb * 1024, seed=args.seed):
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+    elif args.command == "unsync":
+        for result in benchUnsync(pictureSize=args.picture_mb * 1024 * 1024, repeat=args.repeat):
+            print json.dumps(result, sort_keys=True)
+    elif args.command == "generate":
+        generateCorpus(args.dir, count=args.count, profiles=args.profile or PROFILES.keys(),
+                       audioSize=args.audio_kb * 1024, seed=args.seed)
@@ -1,19 +1,65 @@
 #!/usr/bin/env python
 #coding:utf8
+import atexit
+import collections
+import copy
+import cPickle
+import cStringIO
+import csv
 import datetime
+import functools
+import hashlib
+import itertools
+import json
 import time
 import logging
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
+import Queue
+import re
+import shutil
+import sqlite3
 import sys
 import struct
+import tempfile
+import threading
+import timeit
 import traceback
+import zlib
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-fmt = logging.Formatter('%(asctime)s %(levelname)s: %(pathname)s:%(lineno)d %(message)s')
-handler = logging.StreamHandler()
-handler.setFormatter(fmt=fmt)
-logger.addHandler(handler)
+logger.addHandler(logging.NullHandler())
+LOG_FORMAT = '%(asctime)s %(levelname)s: %(pathname)s:%(lineno)d %(message)s'
+
+# submitted and not yet printed files per worker in directory scan
+SCAN_IN_FLIGHT_PER_JOB = 4
+
+# buffer size of file copies when os.sendfile is not available
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# threads for Tag.parseAsync and Tag.parseMany
+DEFAULT_CONCURRENCY = 8
+DEFAULT_THREAD_POOL = None
+
+# Stats of this process, None unless enableStats() is called
+STATS = None
+
+# diagnostic code -> severity, see Tag.diagnose
+DIAGNOSTIC_LEVELS = {
+    "unknown-frame": logging.INFO,
+    "truncated-frame": logging.WARNING,
+    "trailing-bytes": logging.DEBUG,
+    "unknown-genre": logging.INFO,
+    # recorded when the frame is first decoded, see Frame.undecoded
+    "decompress-failed": logging.WARNING,
+}
+
+# $FF followed by %111xxxxx or $00, which unsynchronisation breaks by $00
+UNSYNC_PATTERN = re.compile('\xff(?=[\x00\xe0-\xff])')
+
+Diagnostic = collections.namedtuple('Diagnostic', ['code', 'frameID', 'offset', 'level', 'detail'])
 
 NONE_GENRE = 255
 GENRES = [
@@ -55,6 +101,19 @@ ENCODINGS = [
     'ISO8859-1', 'UTF-16', 'UTF-16BE', 'UTF-8',
 ]
 
+# codecs tried in order for ID3v1 text and v2 text labelled ISO-8859-1 but
+# written in a local code page, the first one decoding all strings of a tag
+# wins; the first codec should be a strict one like UTF-8, and codecs where
+# $00 is only ever NUL, e.g. 'shift_jis' or 'cp1251' may be appended
+CHARSETS = ['utf-8', 'gbk']
+# decodes any bytes, used when no codec of CHARSETS does
+CHARSET_FALLBACK = 'ISO8859-1'
+# directory -> codec of CHARSETS last detected for a tag of a file in it
+CHARSET_CACHE = {}
+CHARSET_CACHE_SIZE = 4096
+
+NON_ASCII = re.compile('[\x80-\xff]')
+
 
 IDS = {
     #
@@ -100,6 +159,9 @@ IDS = {
     "USLT": "unsychronizedLyric",
 }
 
+# frame ID in human -> frame ID
+IDS_HUMAN = dict((v, k) for k, v in IDS.iteritems())
+
 
 PICTURE_TYPES = {
     0x00: "Other",
@@ -132,14 +194,347 @@ def getByValue(value, d):
             return k
 
 
+def filepathOf(fileobj):
+    filepath = getattr(fileobj, 'name', None)
+    if isinstance(filepath, basestring) and os.path.isfile(filepath):
+        return filepath
+
+
+class Stats(object):
+    """
+    Counters and timers (seconds) of parsing and writing, aggregated
+    per process over all threads.
+
+    counters
+        - read.calls, read.bytes, seek.calls of files opened by the parser
+        - frames.<class> frames parsed per frame class
+        - charset.<codec> tags decoded by codec, charset.ascii for ASCII only
+        - <timer>.calls for each timer
+    timers
+        - parse.header tag header, parse.frames frame walk with eager decoding,
+          parse.v1 ID3v1 tag
+        - decode.<class> payload decoding per frame class, text decoding is
+          decode.FrameText, decode.FrameComment, ...
+        - dumps, saveAs, saveInPlace, saveToAudioFile
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def addTime(self, name, seconds):
+        with self.lock:
+            self.timers[name] += seconds
+            self.counters[name + '.calls'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "timers": dict(self.timers),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+
+def enableStats():
+    global STATS
+    if STATS is None:
+        STATS = Stats()
+    return STATS
+
+
+def disableStats():
+    global STATS
+    STATS = None
+
+
+def statsSnapshot():
+    """ snapshot of this process stats, None when not enabled """
+    stats = STATS
+    if stats is not None:
+        return stats.snapshot()
+
+
+def timed(name):
+    """ add time of calls to timer name when stats are enabled """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = STATS
+            if stats is None:
+                return func(*args, **kwargs)
+
+            started = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.addTime(name, timeit.default_timer() - started)
+        return wrapper
+    return decorator
+
+
+class CountingFile(object):
+    """ File wrapper counting reads and seeks into stats """
+
+    def __init__(self, fileobj, stats):
+        self.fileobj = fileobj
+        self.stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def __iter__(self):
+        return iter(self.fileobj)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fileobj.close()
+
+    def read(self, *args):
+        chunk = self.fileobj.read(*args)
+        self.stats.count('read.calls')
+        self.stats.count('read.bytes', len(chunk))
+        return chunk
+
+    def seek(self, *args):
+        self.stats.count('seek.calls')
+        return self.fileobj.seek(*args)
+
+
+def openCounted(filepath, mode='rb'):
+    """ open filepath, reads and seeks are counted when stats are enabled """
+    fileobj = open(filepath, mode)
+    stats = STATS
+    if stats is not None:
+        return CountingFile(fileobj, stats)
+    return fileobj
+
+
+def jsonValue(value):
+    """ unicode for bytes, which JSON can not hold """
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('ISO8859-1')
+    return value
+
+
+def copyFileRange(fsrc, fdst, offset, length, bufsize=COPY_BUFFER_SIZE):
+    """
+    Copy length bytes at offset of fsrc to current position of fdst,
+    by os.sendfile when available, else with a fixed size buffer.
+    """
+    fdst.flush()
+
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is not None:
+        position = fdst.tell()
+        copied = 0
+        while copied < length:
+            sent = sendfile(fdst.fileno(), fsrc.fileno(), offset + copied, min(length - copied, 1 << 30))
+            if not sent:
+                break
+            copied += sent
+        fdst.seek(position + copied, os.SEEK_SET)
+        return copied
+
+    fsrc.seek(offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        chunk = fsrc.read(min(bufsize, length - copied))
+        if not chunk:
+            break
+        fdst.write(chunk)
+        copied += len(chunk)
+    return copied
+
+
+def replaceFile(filepath, head, src, offset, length, tail=''):
+    """
+    Atomically replace filepath by head, length bytes at offset of src
+    and tail, through a temporary file in the same directory.
+    """
+    dirname, basename = os.path.split(filepath)
+    fd, filepathTemp = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.tmp', dir=dirname or '.')
+    try:
+        with os.fdopen(fd, 'wb') as fdst:
+            fdst.write(head)
+            copyFileRange(src, fdst, offset=offset, length=length)
+            fdst.write(tail)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+        if os.path.exists(filepath):
+            shutil.copymode(filepath, filepathTemp)
+        os.rename(filepathTemp, filepath)
+    except:
+        if os.path.exists(filepathTemp):
+            os.remove(filepathTemp)
+        raise
+
+
+def shiftFileRange(fileobj, offset, length, bufsize=COPY_BUFFER_SIZE):
+    """
+    Move length bytes at offset of fileobj, opened in r+b mode, down to
+    the start of file with a fixed size buffer and truncate the rest.
+    """
+    copied = 0
+    while copied < length:
+        fileobj.seek(offset + copied, os.SEEK_SET)
+        chunk = fileobj.read(min(bufsize, length - copied))
+        if not chunk:
+            break
+        fileobj.seek(copied, os.SEEK_SET)
+        fileobj.write(chunk)
+        copied += len(chunk)
+
+    fileobj.truncate(copied)
+    fileobj.flush()
+    return copied
+
+
+def inflateRange(buf, offset, size, limit, chunkSize=64 * 1024):
+    """
+    zlib decompress buf[offset:offset+size] chunk by chunk, output is
+    capped at limit bytes, input past the cap is not decompressed.
+    """
+    decompressor = zlib.decompressobj()
+    chunks = []
+    produced = 0
+
+    position, end = offset, offset + size
+    while position < end and produced < limit:
+        chunk = decompressor.decompress(sliceBytes(buf, position, min(position + chunkSize, end)), limit - produced)
+        position += chunkSize
+        chunks.append(chunk)
+        produced += len(chunk)
+
+        # input held back by the cap
+        if decompressor.unconsumed_tail:
+            break
+
+    if produced < limit:
+        chunks.append(decompressor.flush()[:limit - produced])
+    return ''.join(chunks)
+
+
+def compressTextOver(minSize):
+    """ Frame.COMPRESS_POLICY compressing text, comment and lyrics frames of minSize bytes or more """
+    def policy(frame, size):
+        return size >= minSize and isinstance(frame, (
+            FrameText, FrameUserDefinedTextInformation, FrameComment, SynchronisedLyrics))
+    return policy
+
+
+def splitTerminated(raw, encoding):
+    """
+    Split raw at the string terminator of encoding, $00 or $00 00 for
+    UTF-16, returns (string bytes, remain bytes)
+    """
+    if encoding in ['UTF-16', 'UTF-16BE']:
+        idx = raw.find('\x00\x00')
+        while idx != -1 and idx % 2:
+            idx = raw.find('\x00\x00', idx + 1)
+        width = 2
+    else:
+        idx = raw.find('\x00')
+        width = 1
+
+    if idx == -1:
+        return raw, ''
+    return raw[:idx], raw[idx + width:]
+
+
+def splitValues(raw, encoding):
+    """
+    Split raw at every string terminator of encoding, for v2.4 multi-value
+    text frames, a trailing terminator does not start a value
+    """
+    if encoding in ['UTF-16', 'UTF-16BE']:
+        pieces = []
+        while raw:
+            piece, raw = splitTerminated(raw, encoding)
+            pieces.append(piece)
+        return pieces
+
+    pieces = raw.split('\x00')
+    if len(pieces) > 1 and not pieces[-1]:
+        pieces.pop()
+    return pieces
+
+
+def charsetDirectory(filepath):
+    """ key of CHARSET_CACHE for filepath, None when unknown """
+    if filepath is not None:
+        return os.path.dirname(os.path.abspath(filepath))
+
+
+def decodeLegacy(strings, directory=None):
+    """
+    Decode byte strings of one tag with a single codec, returns
+    (codec, unicode strings), codec None when they are all ASCII.
+
+    Codecs of CHARSETS are tried on all strings at once without raising,
+    the codec last detected in directory right after the first one.
+    """
+    raw = '\x00'.join(strings)
+    stats = STATS
+    if NON_ASCII.search(raw) is None:
+        if stats is not None:
+            stats.count('charset.ascii')
+        return None, [s.decode('ascii') for s in strings]
+
+    candidates = CHARSETS
+    cached = CHARSET_CACHE.get(directory) if directory is not None else None
+    if cached is not None and cached in CHARSETS[1:]:
+        candidates = [CHARSETS[0], cached] + [c for c in CHARSETS[1:] if c != cached]
+
+    for codec in candidates:
+        text = raw.decode(codec, 'replace')
+        if u'\ufffd' not in text:
+            break
+    else:
+        codec = CHARSET_FALLBACK
+        text = raw.decode(codec)
+
+    if directory is not None and codec != cached and codec in CHARSETS:
+        if len(CHARSET_CACHE) >= CHARSET_CACHE_SIZE:
+            CHARSET_CACHE.clear()
+        CHARSET_CACHE[directory] = codec
+    if stats is not None:
+        stats.count('charset.' + codec)
+
+    values = text.split(u'\x00')
+    if len(values) != len(strings):
+        # NUL within a string
+        values = [s.decode(codec, 'replace') for s in strings]
+    return codec, values
+
+
+def sliceBytes(buf, start, end):
+    chunk = buf[start:end]
+    if isinstance(chunk, memoryview):
+        return chunk.tobytes()
+    return chunk
+
+
 class HelperString(object):
     @staticmethod
     def to_uni(obj):
         if isinstance(obj, bytes):
-            try:
-                return obj.decode('utf-8')
-            except UnicodeDecodeError:
-                return obj.decode('gbk')
+            return decodeLegacy([obj])[1][0]
         elif isinstance(obj, (int, long)):
             return unicode(obj)
         elif isinstance(obj, (datetime.date, datetime.datetime)):
@@ -181,6 +576,9 @@ class Tag(object):
 
     V1X_SIZE = 128
 
+    # padding added when the tag is rewritten, bytes or callable of tag size
+    PADDING = 2048
+
     FILE_ID_V1X = "TAG"
     FILE_ID_V2X = "ID3"
 
@@ -189,6 +587,16 @@ class Tag(object):
 
     VERSION_MAJOR_SUPPORT = [3, 4]
 
+    # frames an ID3v1 tag can hold, dumps drops the others
+    V1_FRAME_IDS = ["TIT2", "TPE1", "TALB", "TYER", "COMM", "TRCK", "TCON"]
+
+    # diagnostics below this level are not recorded
+    DIAGNOSTIC_LEVEL = logging.INFO
+    # keep raw bytes of offending frames in Diagnostic.detail
+    DIAGNOSTIC_DETAIL = False
+
+    # parseFromFilepath redecodes v2 ISO-8859-1 text with CHARSETS, see redecodeLatin1
+    DETECT_CHARSET_V2 = False
 
     def __init__(self, versionX, versionMajor, revision=None, size=None):
         """
@@ -211,9 +619,26 @@ class Tag(object):
 
         self.frames = []
 
+        # Diagnostic records of problems found while parsing
+        self.diagnostics = []
+
+        # codec legacy text was decoded with, None for ASCII or spec encodings
+        self.charset = None
+
+        # frame ID -> frames, in order of appearance
+        self.frameIndex = {}
+        # (frame ID, key) -> frame for TXXX description and COMM (language, description),
+        # built on first lookup because keys need payload decoded
+        self.descriptionIndex = None
+
 
     @staticmethod
     def isV1x(fileobj):
+        fileobj.seek(0, os.SEEK_END)
+        if fileobj.tell() < Tag.V1X_SIZE:
+            fileobj.seek(0, os.SEEK_SET)
+            return False
+
         fileobj.seek(-Tag.V1X_SIZE, os.SEEK_END)
         rawTag = fileobj.read(Tag.V1X_SIZE)
         fileobj.seek(0, os.SEEK_SET)
@@ -222,43 +647,201 @@ class Tag(object):
     @staticmethod
     def isV2x(fileobj, filesize):
         rawHeader = fileobj.read(Tag.HEADER_SIZE)
-        fileId, versionMajor, revision, flags, size = struct.unpack("!3sBBBL", rawHeader)
         fileobj.seek(0, os.SEEK_SET)
+        return Tag.isV2xBuffer(buf=rawHeader, filesize=filesize)
+
+    @staticmethod
+    def isV1xBuffer(buf):
+        return len(buf) >= Tag.V1X_SIZE and buf[-Tag.V1X_SIZE:-Tag.V1X_SIZE + 3] == Tag.FILE_ID_V1X
+
+    @staticmethod
+    def isV2xBuffer(buf, filesize):
+        if len(buf) < Tag.HEADER_SIZE:
+            return False
+
+        fileId, versionMajor, revision, flags, size = struct.unpack_from("!3sBBBL", buf, 0)
 
         return fileId == Tag.FILE_ID_V2X and \
                versionMajor in [3, 4] and \
                revision == 0 and \
-               size <= filesize
+               Tag.syncsafeDecode(size) <= filesize
+
+    @staticmethod
+    def probe(filepath):
+        """
+        Tag version, flags, declared size, presence of v1 tail and audio
+        region of filepath, from at most one head read and one tail read.
+        """
+        with openCounted(filepath) as fileobj:
+            filesize = os.fstat(fileobj.fileno()).st_size
+
+            rawHeader = fileobj.read(Tag.HEADER_SIZE)
+
+            rawTail = ''
+            if filesize >= Tag.V1X_SIZE:
+                fileobj.seek(-Tag.V1X_SIZE, os.SEEK_END)
+                rawTail = fileobj.read(Tag.V1X_SIZE)
+
+        result = Tag.probeBuffer(rawHeader=rawHeader, rawTail=rawTail, filesize=filesize)
+        result["filepath"] = filepath
+        return result
+
+    @staticmethod
+    def probeBuffer(rawHeader, rawTail, filesize):
+        result = {
+            "filesize": filesize,
+            "version": None,
+            "flags": None,
+            "size": None,
+            "hasV1": False,
+            "audioOffset": 0,
+            "audioEnd": filesize,
+        }
+
+        if Tag.isV1xBuffer(buf=rawTail):
+            result["hasV1"] = True
+            result["size"] = Tag.V1X_SIZE
+            result["audioEnd"] = filesize - Tag.V1X_SIZE
+
+            if rawTail[125] == '\0' and rawTail[126] not in ['\0', ' ']:
+                result["version"] = (1, 1)
+            else:
+                result["version"] = (1, 0)
+
+        if Tag.isV2xBuffer(buf=rawHeader, filesize=filesize):
+            fileId, versionMajor, revision, flags, size = struct.unpack("!3sBBBL", rawHeader)
+            size = Tag.syncsafeDecode(size)
+
+            result["version"] = (2, versionMajor, revision)
+            result["flags"] = flags
+            result["size"] = size
+
+            audioOffset = Tag.HEADER_SIZE + size
+            if versionMajor >= 4 and flags & (1 << 4):
+                # footer
+                audioOffset += Tag.HEADER_SIZE
+            result["audioOffset"] = min(audioOffset, result["audioEnd"])
+
+        return result
+
+    @staticmethod
+    def probeMany(filepaths):
+        """ yield Tag.probe of each file, with "error" set instead for files failed to read """
+        for filepath in filepaths:
+            try:
+                yield Tag.probe(filepath)
+            except EnvironmentError as e:
+                yield {"filepath": filepath, "error": str(e)}
+
+    @staticmethod
+    def parseAsync(filepath, pool=None, **kwargs):
+        """
+        Parse filepath on pool, a shared thread pool by default, returns
+        an AsyncResult whose get() gives the tag or raises the parse error.
+        kwargs are passed to Tag.parseFromFilepath.
+        """
+        if pool is None:
+            pool = defaultThreadPool()
+        return pool.apply_async(Tag.parseFromFilepath, (filepath, ), kwargs)
+
+    @staticmethod
+    def parseMany(filepaths, concurrency=DEFAULT_CONCURRENCY, pool=None, ordered=False, **kwargs):
+        """
+        Parse filepaths on concurrency threads, or on pool, e.g. a
+        multiprocessing.Pool, when given, and yield (filepath, tag, error).
+        At most concurrency * SCAN_IN_FLIGHT_PER_JOB files are in flight,
+        filepaths is consumed as results are taken.
+        """
+        items = ((filepath, kwargs) for filepath in filepaths)
+
+        ownPool = pool is None
+        if ownPool:
+            pool = multiprocessing.pool.ThreadPool(processes=concurrency)
+
+        try:
+            for result in imapBounded(pool, parseTask, items,
+                                      window=concurrency * SCAN_IN_FLIGHT_PER_JOB, ordered=ordered):
+                yield result
+        finally:
+            if ownPool:
+                pool.terminate()
+                pool.join()
 
     @staticmethod
-    def parseFromFilepath(filepath):
-        with open(filepath) as fileobj:
+    def parseFromFilepath(filepath, useMmap=False, lazy=False):
+        """
+        With lazy=True only frame headers are parsed, frame payloads are
+        decoded on first access of their attributes.
+        """
+        with openCounted(filepath) as fileobj:
             fstat = os.stat(filepath)
-            return Tag.parseFromFile(fileobj=fileobj, filesize=fstat.st_size)
+            tag = Tag.parseFromFile(fileobj=fileobj, filesize=fstat.st_size, useMmap=useMmap, lazy=lazy)
+
+        if tag is not None and tag.versionX == 2 and Tag.DETECT_CHARSET_V2:
+            tag.redecodeLatin1(directory=charsetDirectory(filepath))
+        return tag
 
     @staticmethod
-    def parseFromFile(fileobj, filesize):
+    def parseFromFile(fileobj, filesize, useMmap=False, lazy=False):
+        if useMmap:
+            if filesize == 0:
+                return
+
+            source = filepathOf(fileobj)
+
+            buf = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            if lazy:
+                # pending frames slice the mapping, it is unmapped when they are gone
+                return Tag.parseFromBuffer(buf=buf, lazy=lazy, source=source)
+
+            try:
+                tag = Tag.parseFromBuffer(buf=buf, source=source)
+                if tag is not None and source is None:
+                    # no file path to read pictures from once buf is unmapped
+                    for frame in tag.frameIndex.get("APIC", []):
+                        if frame.picture is not None and frame.picture.buf is buf:
+                            frame.picture.detach()
+                return tag
+            finally:
+                buf.close()
+
         if Tag.isV2x(fileobj=fileobj, filesize=filesize):
-            return Tag.parseV2FromFile(fileobj=fileobj)
+            return Tag.parseV2FromFile(fileobj=fileobj, lazy=lazy)
         elif Tag.isV1x(fileobj=fileobj):
             return Tag.parseV1FromFile(fileobj=fileobj)
 
+    @staticmethod
+    def parseFromBuffer(buf, lazy=False, source=None):
+        """
+        Parse tag from the whole file content, e.g. a mmap of it,
+        v2 head and v1 tail are both slices of buf.
+        """
+        if Tag.isV2xBuffer(buf=buf, filesize=len(buf)):
+            return Tag.parseV2FromBuffer(buf=buf, lazy=lazy, source=source)
+        elif Tag.isV1xBuffer(buf=buf):
+            return Tag.parseV1FromBuffer(rawTag=buf[-Tag.V1X_SIZE:], directory=charsetDirectory(source))
+
     @staticmethod
     def parseV1FromFile(fileobj):
+        fileobj.seek(-Tag.V1X_SIZE, os.SEEK_END)
+        rawTag = fileobj.read(Tag.V1X_SIZE)
+        return Tag.parseV1FromBuffer(rawTag=rawTag, directory=charsetDirectory(filepathOf(fileobj)))
+
+    @staticmethod
+    @timed('parse.v1')
+    def parseV1FromBuffer(rawTag, directory=None):
         """
+        Text fields are decoded with one codec of CHARSETS for the whole tag,
+        directory, of the file when known, picks the codec to try first.
+
         Reference
          - http://id3.org/ID3v1
         """
         tag = Tag(versionX=1, versionMajor=0, size=Tag.V1X_SIZE)
 
-        fileobj.seek(-Tag.V1X_SIZE, os.SEEK_END)
-        rawTag = fileobj.read(Tag.V1X_SIZE)
-
-        title = rawTag[3:33].strip('\x00 ')
-        artist = rawTag[33:63].strip('\x00 ')
-        album = rawTag[63:93].strip('\x00 ')
-        year = rawTag[93:97].strip('\x00 ')
-        comment = rawTag[97:127].strip('\x00 ')
+        fields = [rawTag[start:end].strip('\x00 ') for start, end in ((3, 33), (33, 63), (63, 93), (93, 97), (97, 127))]
+        tag.charset, fields = decodeLegacy(fields, directory=directory)
+        title, artist, album, year, comment = fields
 
         track = None
         if rawTag[125] == '\0' and rawTag[126] not in ['\0', ' ']:
@@ -269,8 +852,7 @@ class Tag(object):
         try:
             genre = GENRES[ord(rawTag[127])]
         except IndexError:
-            msg = "parse genre failed -%s-" % rawTag[127]
-            logger.warn(msg)
+            tag.diagnose("unknown-genre", offset=127, detail=rawTag[127])
 
         tag.frameAppend(FrameText(
             versionX=tag.versionX,
@@ -319,22 +901,91 @@ class Tag(object):
         return tag
 
     @staticmethod
-    def parseV2FromFile(fileobj):
+    def syncsafeDecode(n):
+        """ 28-bit syncsafe integer, 7 bits per byte """
+        return (n & 0x7f) | ((n >> 8) & 0x7f) << 7 | ((n >> 16) & 0x7f) << 14 | ((n >> 24) & 0x7f) << 21
+
+    @staticmethod
+    def syncsafeEncode(n):
+        return (n & 0x7f) | ((n >> 7) & 0x7f) << 8 | ((n >> 14) & 0x7f) << 16 | ((n >> 21) & 0x7f) << 24
+
+    @staticmethod
+    def unsyncDecode(raw):
+        """ reverse unsynchronisation, $FF 00 -> $FF """
+        return raw.replace('\xff\x00', '\xff')
+
+    @staticmethod
+    def unsyncEncode(raw):
+        """ unsynchronisation, $00 after $FF followed by %111xxxxx or $00 and after a trailing $FF """
+        if '\xff' not in raw:
+            return raw
+
+        raw = UNSYNC_PATTERN.sub('\xff\x00', raw)
+        if raw[-1] == '\xff':
+            raw += '\x00'
+        return raw
+
+    @staticmethod
+    def parseV2FromFile(fileobj, lazy=False):
         """
+        Read the whole tag region at once and walk frames over it.
+
         Reference
             - http://id3.org/id3v2.3.0
             - http://id3.org/id3v2.4.0-structure
         """
+        position = fileobj.tell()
         rawHeader = fileobj.read(Tag.HEADER_SIZE)
         if len(rawHeader) != Tag.HEADER_SIZE:
             msg = 'parse v2 header failed'
             logger.error(msg)
             return
 
-        fileId, versionMajor, revision, flags, size = struct.unpack("!3sBBBL", rawHeader)
+        tag = Tag.parseV2Header(rawHeader)
+        if tag is None:
+            return
+
+        source = filepathOf(fileobj)
+
+        rawFrames = fileobj.read(tag.size)
+        if tag.unsynchronisation and tag.versionMajor == 3:
+            # frames are laid out in the resynchronised tag, not in the file
+            rawFrames = Tag.unsyncDecode(rawFrames)
+            source = None
 
-        # print '>> header  FID, version, flags, size'
-        # print fileId, versionMajor, revision, flags, size
+        Tag.parseV2Frames(tag=tag, buf=memoryview(rawFrames), offset=0, end=len(rawFrames), lazy=lazy,
+                          source=source, sourceOffset=position + Tag.HEADER_SIZE)
+        return tag
+
+    @staticmethod
+    def parseV2FromBuffer(buf, lazy=False, source=None):
+        """
+        Parse tag from any buffer which starts with ID3v2 header,
+        e.g. str, memoryview or mmap. Only frame payloads are copied out.
+        """
+        if len(buf) < Tag.HEADER_SIZE:
+            msg = 'parse v2 header failed'
+            logger.error(msg)
+            return
+
+        tag = Tag.parseV2Header(buf[:Tag.HEADER_SIZE])
+        if tag is None:
+            return
+
+        end = min(Tag.HEADER_SIZE + tag.size, len(buf))
+        if tag.unsynchronisation and tag.versionMajor == 3:
+            rawFrames = Tag.unsyncDecode(sliceBytes(buf, Tag.HEADER_SIZE, end))
+            Tag.parseV2Frames(tag=tag, buf=memoryview(rawFrames), offset=0, end=len(rawFrames), lazy=lazy)
+            return tag
+
+        Tag.parseV2Frames(tag=tag, buf=buf, offset=Tag.HEADER_SIZE, end=end, lazy=lazy, source=source)
+        return tag
+
+    @staticmethod
+    @timed('parse.header')
+    def parseV2Header(rawHeader):
+        fileId, versionMajor, revision, flags, size = struct.unpack("!3sBBBL", rawHeader)
+        size = Tag.syncsafeDecode(size)
 
         if versionMajor in Tag.VERSION_MAJOR_SUPPORT:
             tag = Tag(versionX=2, versionMajor=versionMajor, revision=revision, size=size)
@@ -343,6 +994,8 @@ class Tag(object):
             logger.warn(msg)
             return
 
+        tag.flags = flags
+
         if flags & (1 << 7):
             tag.unsynchronisation = True
         if flags & (1 << 6):
@@ -354,119 +1007,165 @@ class Tag(object):
             if flags & (1 << 4):
                 tag.footerPresent = True
 
-        bytesLeft = size
+        return tag
 
-        while bytesLeft > 0:
-            rawHeaderFrame = fileobj.read(Tag.HEADER_SIZE)
-            bytesLeft -= len(rawHeaderFrame)
+    @staticmethod
+    @timed('parse.frames')
+    def parseV2Frames(tag, buf, offset, end, lazy=False, source=None, sourceOffset=0):
+        """
+        Walk frames in buf[offset:end] by offset, payload is sliced out
+        only for frames that get decoded. With lazy=True frames keep
+        (buf, offset, size) and decode on first access.
 
-            if len(rawHeaderFrame) != Tag.HEADER_SIZE:
-                msg = 'skip invalid frame header or padding'
-                logger.debug(msg)
+        source is the file path which buf[0] is read from at sourceOffset,
+        large payloads (pictures) refer to it instead of buf.
+        """
+        while offset < end:
+            if offset + Tag.HEADER_SIZE > end:
+                tag.diagnose("trailing-bytes", offset=sourceOffset + offset)
                 break
 
-            frameID, frameSize, frameFlags = struct.unpack("!4sLH", rawHeaderFrame)
-            # print '>> frame, FID, size, flags'
-            # print frameID, frameSize, frameFlags
-
-            # if frameSize is 0:
-            #     print repr(rawHeaderFrame), bytesLeft
-            #     print repr(fileobj.read())
+            frameID, frameSize, frameFlags = struct.unpack_from("!4sLH", buf, offset)
+            offset += Tag.HEADER_SIZE
+            if tag.versionMajor >= 4:
+                frameSize = Tag.syncsafeDecode(frameSize)
 
             if not Frame.validID(frameID):
                 break
-            elif len(frameID) != Tag.FRAME_ID_SIZE:
-                break
 
-            if frameID == "APIC":
-                clsFrame = FrameAttachedPicture
-            elif frameID == "COMM":
-                clsFrame = FrameComment
-            elif frameID[0] == "W":
-                clsFrame = FrameURLLink
-            elif frameID == "TXXX":
-                clsFrame = FrameUserDefinedTextInformation
-            elif frameID == "PRIV":
-                clsFrame = FramePrivate
-            elif frameID == "USLT":
-                clsFrame = SynchronisedLyrics
+            clsFrame = FRAME_CLASS_CACHE.get(frameID) or Tag.frameClass(frameID)
+            frame = clsFrame(
+                versionX=tag.versionX,
+                versionMajor=tag.versionMajor,
+                frameID=frameID,
+                flags=frameFlags,
+            )
+
+            if clsFrame is FrameUnknown:
+                detail = None
+                if Tag.DIAGNOSTIC_DETAIL:
+                    detail = sliceBytes(buf, offset - Tag.HEADER_SIZE, min(offset + frameSize, end))
+                tag.diagnose("unknown-frame", frameID=frameID, offset=sourceOffset + offset - Tag.HEADER_SIZE,
+                             detail=detail)
+
+            if tag.unsynchronisation and tag.versionMajor >= 4:
+                # v2.4 tag flag means every frame is unsynchronised
+                frame.unsynchronisation = True
+
+            if offset + frameSize > end:
+                tag.diagnose("truncated-frame", frameID=frameID, offset=sourceOffset + offset - Tag.HEADER_SIZE)
+
+            # data length indicator, if any, is in the payload and read by Frame.decodeBuffer,
+            # compressed frames are decompressed on first access only
+            payloadSize = min(frameSize, end - offset)
+            diagnose = None
+            if frameFlags and frame.compression:
+                diagnose = functools.partial(tag.diagnose, offset=sourceOffset + offset - Tag.HEADER_SIZE)
+            if lazy:
+                frame.setPending(buf=buf, offset=offset, size=payloadSize, source=source, sourceOffset=sourceOffset,
+                                 diagnose=diagnose)
+            elif diagnose is not None:
+                # own copy of the payload, buf may be a view or mapping gone after parsing
+                frame.setPending(buf=sliceBytes(buf, offset, offset + payloadSize), offset=0, size=payloadSize,
+                                 diagnose=diagnose)
             else:
-                clsFrame = FrameText
+                frame.decodeBuffer(buf=buf, offset=offset, size=payloadSize, source=source, sourceOffset=sourceOffset)
+            offset += frameSize
 
-            try:
-                frame = clsFrame(
-                    versionX=tag.versionX,
-                    versionMajor=tag.versionMajor,
-                    frameID=frameID,
-                    flags=frameFlags,
-                )
-            except KeyError:
-                # skip this frame
-                rawFrameData = fileobj.read(frameSize)
-                bytesLeft -= len(rawFrameData)
+            tag.frameAppend(frame=frame)
 
-                msg = 'got unexpected frame -%s- -%s-' % (repr(rawHeaderFrame), repr(rawFrameData))
-                logger.warn(msg)
+            stats = STATS
+            if stats is not None:
+                stats.count('frames.' + clsFrame.__name__)
 
-                continue
+    @staticmethod
+    def frameClass(frameID):
+        """ frame class registered for frameID, see registerFrameClass """
+        clsFrame = FRAME_CLASS_CACHE.get(frameID)
+        if clsFrame is None:
+            clsFrame = FRAME_CLASSES.get(frameID) or FRAME_CLASS_PREFIXES.get(frameID[:1], FrameUnknown)
+            FRAME_CLASS_CACHE[frameID] = clsFrame
+        return clsFrame
+
+    @staticmethod
+    def iterFrames(fileobj, want=None, predicate=None):
+        """
+        Stream frames of the ID3v2 tag at current position of fileobj,
+        yield frames whose ID is in want and for which
+        predicate(frameID, frameSize, frameFlags) is true.
+        Payloads of other frames are skipped by seek, and the stream stops
+        once every ID in want has been seen.
+        """
+        rawHeader = fileobj.read(Tag.HEADER_SIZE)
+        if len(rawHeader) != Tag.HEADER_SIZE:
+            return
 
-            if tag.versionMajor == 3:
-                # %abc00000 %ijk00000
-                if frame.flags & (1 << (7 + 8)):
-                    frame.tagAlterPreservation = True
-                if frame.flags & (1 << (6 + 8)):
-                    frame.fileAlterPreservation = True
-                if frame.flags & (1 << (5 + 8)):
-                    frame.readonly = True
+        tag = Tag.parseV2Header(rawHeader)
+        if tag is None:
+            return
 
-                if frame.flags & (1 << 7):
-                    frame.readonly = True
+        source = filepathOf(fileobj)
 
-                if frame.flags & (1 << 6):
-                    frame.compression = True
+        bytesLeft = tag.size
+        if tag.unsynchronisation and tag.versionMajor == 3:
+            rawFrames = Tag.unsyncDecode(fileobj.read(tag.size))
+            fileobj = cStringIO.StringIO(rawFrames)
+            bytesLeft = len(rawFrames)
+            source = None
 
-                    decompressedSize = struct.unpack("!L", fileobj.read(4))[0]
-                    bytesLeft -= 4
+        if want is not None:
+            want = set(want)
+            remain = set(want)
 
-                if frame.flags & (1 << 5):
-                    frame.encryption = True
+        while bytesLeft >= Tag.HEADER_SIZE:
+            rawHeaderFrame = fileobj.read(Tag.HEADER_SIZE)
+            bytesLeft -= len(rawHeaderFrame)
 
-            elif tag.versionMajor == 4:
-                # %0abc0000 %0h00kmnp
-                if frame.flags & (1 << (6 + 8)):
-                    frame.tagAlterPreservation = True
-                if frame.flags & (1 << (5 + 8)):
-                    frame.fileAlterPreservation = True
-                if frame.flags & (1 << (4 + 8)):
-                    frame.readonly = True
+            if len(rawHeaderFrame) != Tag.HEADER_SIZE:
+                break
 
-                if frame.flags & (1 << 6):
-                    frame.groupingIdentity = True
+            frameID, frameSize, frameFlags = struct.unpack("!4sLH", rawHeaderFrame)
+            if tag.versionMajor >= 4:
+                frameSize = Tag.syncsafeDecode(frameSize)
 
-                if frame.flags & (1 << 4):
-                    frame.compression = True
+            if not Frame.validID(frameID):
+                break
 
-                    decompressedSize = struct.unpack("!L", fileobj.read(4))[0]
-                    bytesLeft -= 4
+            wanted = want is None or frameID in want
+            if wanted and predicate is not None:
+                wanted = predicate(frameID, frameSize, frameFlags)
 
-                if frame.flags & (1 << 3):
-                    frame.encryption = True
-                if frame.flags & (1 << 2):
+            if wanted:
+                frame = Tag.frameClass(frameID)(
+                    versionX=tag.versionX,
+                    versionMajor=tag.versionMajor,
+                    frameID=frameID,
+                    flags=frameFlags,
+                )
+                if tag.unsynchronisation and tag.versionMajor >= 4:
                     frame.unsynchronisation = True
-                if frame.flags & (1 << 1):
-                    frame.dataLengthIndicator = True
 
-            rawFrameData = fileobj.read(frameSize)
-            # print '>> frame data'
-            # print repr(rawFrameData)
-            # print
+            if not wanted:
+                fileobj.seek(frameSize, os.SEEK_CUR)
+                bytesLeft -= frameSize
+                continue
 
-            bytesLeft -= len(rawFrameData)
+            sourceOffset = fileobj.tell()
+            rawFrameData = fileobj.read(min(frameSize, max(bytesLeft, 0)))
+            bytesLeft -= frameSize
 
-            frame.parseRawData(rawData=rawFrameData)
-            tag.frameAppend(frame=frame)
+            frame.decodeBuffer(buf=rawFrameData, offset=0, size=len(rawFrameData),
+                               source=source, sourceOffset=sourceOffset)
 
-        return tag
+            stats = STATS
+            if stats is not None:
+                stats.count('frames.' + type(frame).__name__)
+            yield frame
+
+            if want is not None:
+                remain.discard(frameID)
+                if not remain:
+                    break
 
     @staticmethod
     def remove(filepath):
@@ -487,6 +1186,81 @@ class Tag(object):
         return dataAudio
 
 
+    @staticmethod
+    def removeInPlace(filepath, shift=False):
+        """
+        Strip ID3v1 tail and ID3v2 head from filepath without reading audio
+        into memory. A v1 tail is truncated; a v2 head is stripped by copying
+        audio into a temporary file renamed over filepath, or, with shift,
+        by moving audio down in place which is not crash safe.
+        Returns stripped bytes.
+        """
+        probe = Tag.probe(filepath)
+        if probe["size"] is None:
+            return 0
+
+        offset = probe["audioOffset"]
+        length = probe["audioEnd"] - offset
+
+        if offset == 0:
+            with open(filepath, "r+b") as f:
+                f.truncate(length)
+        elif shift:
+            with open(filepath, "r+b") as f:
+                shiftFileRange(f, offset=offset, length=length)
+                os.fsync(f.fileno())
+        else:
+            with open(filepath, "rb") as fsrc:
+                replaceFile(filepath, head='', src=fsrc, offset=offset, length=length)
+
+        return probe["filesize"] - length
+
+    def redecodeLatin1(self, directory=None):
+        """
+        Redecode text of v2 frames labelled ISO-8859-1 with one codec of
+        CHARSETS for the whole tag, for taggers which wrote a local code
+        page instead. Lazy frames are decoded. Returns the codec, None
+        when the text is ASCII.
+        """
+        fields = []
+        for f in self.frames:
+            if getattr(f, 'encoding', None) != 'ISO8859-1':
+                continue
+            for name in ('data', 'description', 'shortDescription', 'contentDescriptor'):
+                if name == 'data' and isinstance(f, FrameURLLink):
+                    # URLs are ISO-8859-1 whatever the description is
+                    continue
+                value = getattr(f, name, None)
+                if isinstance(value, unicode):
+                    fields.append((f, name, value))
+            for i, value in enumerate(getattr(f, 'moreValues', None) or ()):
+                fields.append((f, i, value))
+
+        # ISO-8859-1 decoding is lossless, encoding gives back the raw bytes
+        codec, values = decodeLegacy([value.encode('ISO8859-1') for f, name, value in fields], directory=directory)
+        if codec is None or codec == 'ISO8859-1':
+            return codec
+
+        for (f, name, old), value in zip(fields, values):
+            if isinstance(name, int):
+                f.moreValues[name] = value
+            else:
+                setattr(f, name, value)
+            # written back in an encoding which holds the text
+            f.encoding = 'UTF-16' if f.versionMajor == 3 else 'UTF-8'
+        self.charset = codec
+        self.descriptionIndex = None
+        return codec
+
+    def encodeV1(self, value):
+        """ bytes of a v1 field, in the codec the tag was read with when it holds value """
+        if isinstance(value, unicode) and self.charset is not None:
+            try:
+                return value.encode(self.charset)
+            except UnicodeEncodeError:
+                pass
+        return HelperString.to_str(value)
+
     @property
     def version(self):
         if self.versionX == 1:
@@ -497,7 +1271,13 @@ class Tag(object):
     def __str__(self):
         return str(self.dumps(version=self.version))
 
-    def dumps(self, version):
+    @timed('dumps')
+    def dumps(self, version, padding=0, unsynchronise=False):
+        """
+        padding, for v2 only, is the count of zero bytes after frames,
+        unsynchronise applies unsynchronisation to the whole tag for v2.3
+        and to each frame for v2.4
+        """
         versionX = version[0]
         versionMajor = version[1]
         revision = None
@@ -509,35 +1289,35 @@ class Tag(object):
 
             f = self.getFrame(frameIDHuman="title")
             if f is not None:
-                title = HelperString.to_str(f.data)[:30]
+                title = self.encodeV1(f.data)[:30].ljust(30, '\x00')
             else:
                 title = '\x00' * 30
             chunks.append(title)
 
             f = self.getFrame(frameIDHuman="artist")
             if f is not None:
-                artist = HelperString.to_str(f.data)[:30]
+                artist = self.encodeV1(f.data)[:30].ljust(30, '\x00')
             else:
                 artist = '\x00' * 30
             chunks.append(artist)
 
             f = self.getFrame(frameIDHuman="album")
             if f is not None:
-                album = HelperString.to_str(f.data)[:30]
+                album = self.encodeV1(f.data)[:30].ljust(30, '\x00')
             else:
                 album = '\x00' * 30
             chunks.append(album)
 
             f = self.getFrame(frameIDHuman="year")
             if f is not None:
-                year = HelperString.to_str(f.data)[:4]
+                year = self.encodeV1(f.data)[:4].ljust(4, '\x00')
             else:
                 year = '\x00' * 4
             chunks.append(year)
 
             f = self.getFrame(frameIDHuman="comment")
             if f is not None:
-                comment = HelperString.to_str(f.data)[:30]
+                comment = self.encodeV1(f.data)[:30].ljust(30, '\x00')
             else:
                 comment = '\x00' * 30
 
@@ -548,7 +1328,7 @@ class Tag(object):
 
             if track is not None:
                 if versionMajor == 1:
-                    track = int(track.split('/')[0])
+                    track = int(str(track).split('/')[0])
                     if 0 <= track and track <= 255:
                         segemnts = []
                         prefix = comment[:28]
@@ -585,17 +1365,39 @@ class Tag(object):
             chunks.append(chr(revision))
 
             flags = 0
+            if unsynchronise:
+                flags |= 1 << 7
             chunks.append(struct.pack("!B", flags))
 
             frames = []
             for f in self.frames:
-                frames.append(str(f))
+                if f.versionX == 1:
+                    f = f.toV2(versionMajor=versionMajor)
+                    if f is None:
+                        continue
+                if f.pending is not None and f.flags and f.compression:
+                    f.decodePending()
+                if f.undecoded is not None:
+                    rawFrame = f.dumpsUndecoded(versionMajor=versionMajor)
+                    if rawFrame is None:
+                        msg = 'frame %s not decompressed, dropped from v2.%d tag'
+                        logger.warn(msg, f.id, versionMajor)
+                        continue
+                else:
+                    rawFrame = f.dumps(versionMajor=versionMajor)
+                if unsynchronise and versionMajor >= 4:
+                    rawFrame = Frame.unsyncPacked(rawFrame)
+                frames.append(rawFrame)
             framesInB = ''.join(frames)
 
-            size = len(framesInB)
-            chunks.append(struct.pack('!L', size))
+            if unsynchronise and versionMajor == 3:
+                framesInB = Tag.unsyncEncode(framesInB)
+
+            size = len(framesInB) + padding
+            chunks.append(struct.pack('!L', Tag.syncsafeEncode(size)))
 
             chunks.append(framesInB)
+            chunks.append('\x00' * padding)
 
             b = ''.join(chunks)
         else:
@@ -609,40 +1411,75 @@ class Tag(object):
         assert not (frameID == None and frameIDHuman == None)
 
         if frameID is None:
-            frameID = getByValue(frameIDHuman, IDS)
+            frameID = IDS_HUMAN.get(frameIDHuman)
 
         if frameID is None:
             msg = 'get frame by ID in human -%s- failed' % frameIDHuman
             logger.error(msg)
             return
 
-        for frame in self.frames:
-            if frame.id == frameID:
-                return frame
-
-    def frameAppend(self, frame):
-        self.frames.append(frame)
+        frames = self.frameIndex.get(frameID)
+        if frames:
+            return frames[0]
 
-    def appendFrame(self, flags=None, rawData=None, data=None, frameID=None, frameIDHuman=None):
+    def getFrames(self, frameID=None, frameIDHuman=None):
         assert not (frameID == None and frameIDHuman == None)
 
         if frameID is None:
-            frameID = getByValue(frameIDHuman, IDS)
+            frameID = IDS_HUMAN.get(frameIDHuman)
 
-        if frameID is None:
-            msg = 'get frame by ID in human -%s- failed' % frameIDHuman
-            logger.error(msg)
-            return
+        return list(self.frameIndex.get(frameID, []))
 
-        found = self.getFrame(frameID=frameID, frameIDHuman=frameIDHuman)
-        if found is None:
-            if frameID == "COMM":
-                clsFrame = FrameComment
-            elif frameID == "APIC":
-                clsFrame = FrameAttachedPicture
-            else:
-                clsFrame = FrameText
+    def getUserDefined(self, description):
+        """ TXXX frame by its description """
+        return self.getDescriptionIndex().get(("TXXX", description))
 
+    def getComment(self, language="eng", description=u""):
+        """ COMM frame by its language and short description """
+        return self.getDescriptionIndex().get(("COMM", (language, description)))
+
+    def getDescriptionIndex(self):
+        if self.descriptionIndex is None:
+            index = {}
+            for frame in self.frameIndex.get("TXXX", []):
+                index.setdefault(("TXXX", frame.description), frame)
+            for frame in self.frameIndex.get("COMM", []):
+                index.setdefault(("COMM", (frame.language, frame.shortDescription)), frame)
+            self.descriptionIndex = index
+        return self.descriptionIndex
+
+    def frameAppend(self, frame):
+        self.frames.append(frame)
+        self.frameIndex.setdefault(frame.id, []).append(frame)
+
+        if frame.id in ["TXXX", "COMM"]:
+            self.descriptionIndex = None
+
+    def frameRemove(self, frame):
+        self.frames.remove(frame)
+
+        frames = self.frameIndex.get(frame.id, [])
+        frames.remove(frame)
+        if not frames:
+            self.frameIndex.pop(frame.id, None)
+
+        if frame.id in ["TXXX", "COMM"]:
+            self.descriptionIndex = None
+
+    def appendFrame(self, flags=None, rawData=None, data=None, frameID=None, frameIDHuman=None):
+        assert not (frameID == None and frameIDHuman == None)
+
+        if frameID is None:
+            frameID = IDS_HUMAN.get(frameIDHuman)
+
+        if frameID is None:
+            msg = 'get frame by ID in human -%s- failed' % frameIDHuman
+            logger.error(msg)
+            return
+
+        found = self.getFrame(frameID=frameID, frameIDHuman=frameIDHuman)
+        if found is None:
+            clsFrame = Tag.frameClass(frameID)
             frame = clsFrame(
                 frameID=frameID,
                 frameIDHuman=frameIDHuman,
@@ -656,8 +1493,42 @@ class Tag(object):
         frame.update(data=data)
 
         if found is None:
-            self.frames.append(frame)
+            self.frameAppend(frame=frame)
+
+    def applyEdits(self, edits):
+        """
+        Apply (field, value) edits in order, field is a frame ID with a
+        registered frame class or a human name of IDS, value None removes
+        the frames. Returns changes as (frame ID, old data, new data) for
+        edits that changed the tag.
+        """
+        changes = []
+        for field, value in edits:
+            field = HelperString.to_str(field)
+            if field in IDS or (len(field) == Tag.FRAME_ID_SIZE and Frame.validID(field)
+                                and Tag.frameClass(field) is not FrameUnknown):
+                frameID = field
+            else:
+                frameID = IDS_HUMAN.get(field)
+            if frameID is None:
+                raise ValueError('unknown field %s' % field)
+
+            found = self.getFrame(frameID=frameID)
+            old = found.data if found is not None else None
+            if value is not None:
+                value = HelperString.to_uni(value)
+            if old == value:
+                continue
+
+            if value is None:
+                for frame in self.getFrames(frameID=frameID):
+                    self.frameRemove(frame)
+            else:
+                self.appendFrame(frameID=frameID, frameIDHuman=IDS.get(frameID), data=value)
+            changes.append((frameID, old, value))
+        return changes
 
+    @timed('saveAs')
     def saveAs(self, filepath, version):
         b = self.dumps(version=version)
 
@@ -667,60 +1538,320 @@ class Tag(object):
         msg = 'CREATE %s' % filepath
         logger.debug(msg)
 
+    @timed('saveToAudioFile')
+    def saveToAudioFile(self, srcPath, dstPath, version=None, padding=0):
+        """
+        Write dstPath as audio of srcPath tagged with this tag, replacing
+        the tag of the same version in srcPath and keeping the other one.
+        dstPath is replaced atomically and may be srcPath.
+        """
+        if version is None:
+            version = self.version if self.versionX == 2 else (2, 3, 0)
+
+        probe = Tag.probe(srcPath)
+        b = self.dumps(version=version, padding=padding if version[0] == 2 else 0)
+
+        with open(srcPath, "rb") as fsrc:
+            if version[0] == 1:
+                replaceFile(dstPath, head='', src=fsrc, offset=0, length=probe["audioEnd"], tail=b)
+            else:
+                replaceFile(dstPath, head=b, src=fsrc, offset=probe["audioOffset"],
+                            length=probe["filesize"] - probe["audioOffset"])
+
+        if version[0] == 2:
+            # pictures on srcPath are stale once it is replaced, dstPath holds them all
+            if self.versionX == 2:
+                self.size = len(b) - Tag.HEADER_SIZE
+            self.repointPictures(filepath=dstPath)
+
+        msg = 'CREATE %s' % dstPath
+        logger.debug(msg)
+
+    @staticmethod
+    def paddingFor(size, padding=None):
+        """
+        Padding to add to a tag of size bytes that does not fit in place,
+        padding is an int, a callable of size, or None for Tag.PADDING
+        """
+        if padding is None:
+            padding = Tag.PADDING
+        if callable(padding):
+            padding = padding(size)
+        return max(int(padding), 0)
+
+    @timed('saveInPlace')
+    def saveInPlace(self, filepath, version=None, padding=None):
+        """
+        Write tag into filepath. An ID3v2 tag which fits in the existing
+        tag region, padding included, overwrites that region only;
+        otherwise the file is rewritten with padding from
+        Tag.paddingFor so next edits fit in place.
+        """
+        if version is None:
+            version = self.version if self.versionX == 2 else (2, 3, 0)
+
+        probe = Tag.probe(filepath)
+
+        if version[0] == 1:
+            b = self.dumps(version=version)
+            with open(filepath, "r+b") as f:
+                if probe["hasV1"]:
+                    f.seek(-Tag.V1X_SIZE, os.SEEK_END)
+                else:
+                    f.seek(0, os.SEEK_END)
+                f.write(b)
+
+            msg = 'UPDATE %s' % filepath
+            logger.debug(msg)
+            return
+
+        b = self.dumps(version=version)
+        region = probe["audioOffset"] if probe["size"] is not None and probe["version"][0] == 2 else 0
+
+        if 0 < region and len(b) <= region:
+            b = self.dumps(version=version, padding=region - len(b))
+            with open(filepath, "r+b") as f:
+                f.write(b)
+
+            msg = 'UPDATE %s in place, %d bytes' % (filepath, len(b))
+            logger.debug(msg)
+        else:
+            padding = Tag.paddingFor(size=len(b), padding=padding)
+            b = self.dumps(version=version, padding=padding)
+
+            with open(filepath, "rb") as fsrc:
+                replaceFile(filepath, head=b, src=fsrc, offset=region, length=probe["filesize"] - region)
+
+            msg = 'UPDATE %s rewritten, %d bytes tag' % (filepath, len(b))
+            logger.debug(msg)
+
+        self.size = len(b) - Tag.HEADER_SIZE
+        self.repointPictures(filepath=filepath)
+
+    def repointPictures(self, filepath):
+        """
+        point file backed APIC pictures on filepath to their offsets in the
+        rewritten tag, pictures held in memory are left as they are
+        """
+        # in the order frames are written, frameIndex keeps append order
+        frames = [f for f in self.frames if f.id == "APIC"]
+        if not any(f.picture is not None and f.picture.filepath is not None for f in frames):
+            return
+
+        with open(filepath, "rb") as f:
+            written = Tag.iterFrames(f, predicate=lambda frameID, frameSize, frameFlags: frameID == "APIC")
+            for frame, writtenFrame in zip(frames, written):
+                if frame.picture is not None and frame.picture.filepath is not None:
+                    frame.picture = writtenFrame.picture
+
     def pprint(self):
-        print 'tag v%s' % '.'.join(
+        print self.pformat()
+
+    def pformat(self):
+        lines = ['tag v%s' % '.'.join(
             (str(i) for i in self.version)
-        )
+        )]
 
         for f in self.frames:
+            if f.id == "APIC":
+                    frameIDHuman = IDS[f.id]
+                    lines.append(" %s : " % frameIDHuman)
+                    lines.append("      mimeType : %s" % f.mimeType)
+                    lines.append("      pictureType : %s" % PICTURE_TYPES.get(f.pictureType))
+                    lines.append("      description : %s" % f.description)
+                    lines.append("      pictureData : <... %d bytes ...>" % (len(f.picture) if f.picture is not None else 0))
+                    continue
+
             data =  f.data
             if self.versionX == 1:
                 try:
                     data = HelperString.to_uni(data)
                 except:
                     traceback.print_exc(file=sys.stderr)
-            # elif self.versionX == 2:
-            #     if f.id != "APIC":
-            #         data = f.data.decode(f.encoding)
-            #     else:
-            #         data = f.data
-            # else:
-            #     return
 
-            if f.id == "APIC":
-                    frameIDHuman = IDS[f.id]
-                    print " %s : " % frameIDHuman
-                    print "      mimeType : %s" % f.mimeType
-                    print "      pictureType : %s" % PICTURE_TYPES[f.pictureType]
-                    print "      description : %s" % f.description.decode(f.encoding)
-                    print "      pictureData : <... %d bytes ...>" % len(f.data)
-
-            elif f.id == "TXXX":
-                print " !%s : %s" % (f.description, f.data)
+            if f.id == "TXXX":
+                lines.append(" !%s : %s" % (f.description, f.data))
             elif f.id == "COMM":
                     frameIDHuman = IDS[f.id]
-                    print " %s : " % frameIDHuman
-                    print "      language : %s" % f.language
-                    print "      shortDescription : %s" % f.shortDescription
-                    print "      data : %s" % f.data
+                    lines.append(" %s : " % frameIDHuman)
+                    lines.append("      language : %s" % f.language)
+                    lines.append("      shortDescription : %s" % f.shortDescription)
+                    lines.append("      data : %s" % f.data)
             elif f.id[0] == "T":
+                if f.moreValues:
+                    data = u' / '.join(f.values)
                 try:
                     frameIDHuman = IDS[f.id]
-                    print " %s : %s" % (frameIDHuman, data)
+                    lines.append(" %s : %s" % (frameIDHuman, data))
                 except KeyError:
-                    print " [%s] : %s" % (f.id, data)
+                    lines.append(" [%s] : %s" % (f.id, data))
             else:
                 try:
                     frameIDHuman = IDS[f.id]
-                    print " %s : %s" % (frameIDHuman, data)
+                    lines.append(" %s : %s" % (frameIDHuman, data))
                 except KeyError:
-                    print " [%s] : %s" % (f.id, repr(data))
+                    lines.append(" [%s] : %s" % (f.id, repr(data)))
+
+        lines.append('')
+
+        chunks = []
+        for line in lines:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8', 'replace')
+            chunks.append(line)
+        return u'\n'.join(chunks)
+
+    def estimateSize(self):
+        """ approximate bytes held by tag, pictures count for their full size """
+        size = sys.getsizeof(self) + sys.getsizeof(self.__dict__)
+        for f in self.frames:
+            size += f.estimateSize()
+        return size
+
+    def diagnose(self, code, frameID=None, offset=None, detail=None):
+        """
+        Record a parse problem, severity of code is from DIAGNOSTIC_LEVELS,
+        detail (raw bytes) is kept only with Tag.DIAGNOSTIC_DETAIL.
+        """
+        level = DIAGNOSTIC_LEVELS.get(code, logging.WARNING)
+        if level < Tag.DIAGNOSTIC_LEVEL:
+            return
+
+        if not Tag.DIAGNOSTIC_DETAIL:
+            detail = None
+        self.diagnostics.append(Diagnostic(code, frameID, offset, level, detail))
+
+    def diagnosticCounts(self):
+        return collections.Counter(d.code for d in self.diagnostics)
+
+    def formatDiagnostics(self):
+        """ one line per diagnostic, detail is formatted here only """
+        lines = []
+        for d in self.diagnostics:
+            line = '%s %s' % (logging.getLevelName(d.level), d.code)
+            if d.frameID is not None:
+                line += ' frame %s' % d.frameID
+            if d.offset is not None:
+                line += ' at %d' % d.offset
+            if d.detail is not None:
+                line += ' %r' % d.detail
+            lines.append(line)
+        return lines
+
+    def toDict(self):
+        """ JSON compatible dict, frames keyed by frame ID """
+        frames = {}
+        for f in self.frames:
+            frames.setdefault(f.id, []).append(f.toDict())
+
+        return {
+            "version": list(self.version),
+            "size": self.size,
+            "frames": frames,
+            "diagnostics": [
+                {"code": d.code, "frameID": d.frameID, "offset": d.offset, "level": logging.getLevelName(d.level)}
+                for d in self.diagnostics
+            ],
+        }
+
+
+class LazyField(object):
+    """ Frame attribute which is decoded from the pending payload on first access """
 
-        print
+    def __init__(self, name):
+        self.name = '_' + name
+
+    def __get__(self, frame, cls):
+        if frame is None:
+            return self
+
+        if frame.pending is not None:
+            frame.decodePending()
+        return getattr(frame, self.name, None)
+
+    def __set__(self, frame, value):
+        if frame.pending is not None:
+            # decode first, or the pending payload overwrites value on next access
+            frame.decodePending()
+        setattr(frame, self.name, value)
+
+
+class DataField(LazyField):
+    """ Decoded payload, setting it drops the payload kept undecoded """
+
+    def __set__(self, frame, value):
+        super(DataField, self).__set__(frame, value)
+        frame.undecoded = None
+
+
+class RawDataField(LazyField):
+    """ Raw payload, only retained when Frame.KEEP_RAW_DATA is set """
+
+    def __set__(self, frame, value):
+        if value is not None and not frame.KEEP_RAW_DATA:
+            value = None
+        super(RawDataField, self).__set__(frame, value)
+
+
+class FlagField(object):
+    """ Frame flag packed in Frame.flags, bit mask by tag version major """
+
+    def __init__(self, masks):
+        self.masks = masks
+
+    def __get__(self, frame, cls):
+        if frame is None:
+            return self
+
+        mask = self.masks.get(frame.versionMajor) if frame.versionX == 2 else None
+        return bool(mask and frame.flags & mask)
+
+    def __set__(self, frame, value):
+        mask = self.masks.get(frame.versionMajor) if frame.versionX == 2 else None
+        if not mask:
+            return
+
+        if value:
+            frame.flags |= mask
+        else:
+            frame.flags &= ~mask
 
 
 class Frame(object):
 
+    __slots__ = (
+        'pending', 'versionX', 'versionMajor', 'id', 'frameIDHuman', 'flags',
+        '_data', '_rawData', 'undecoded',
+    )
+
+    # set False to drop raw payloads once frames are parsed
+    KEEP_RAW_DATA = True
+
+    # callable(frame, payload size) -> bool, accepted frames are written
+    # zlib compressed, e.g. compressTextOver(64 * 1024), None disables
+    COMPRESS_POLICY = None
+
+    # compressed frames declaring a larger decompressed size are not decoded
+    MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+    data = DataField("data")
+    rawData = RawDataField("rawData")
+
+    # for v2.3.0, %abc00000 %ijk00000
+    # for v2.4.0, %0abc0000 %0h00kmnp
+
+    ## Frame status flags
+    tagAlterPreservation = FlagField({3: 1 << (7 + 8), 4: 1 << (6 + 8)}) # a
+    fileAlterPreservation = FlagField({3: 1 << (6 + 8), 4: 1 << (5 + 8)}) # b
+    readonly = FlagField({3: 1 << (5 + 8), 4: 1 << (4 + 8)}) # c
+
+    ## Frame format flags
+    compression = FlagField({3: 1 << 7, 4: 1 << 3}) # i, k
+    encryption = FlagField({3: 1 << 6, 4: 1 << 2}) # j, m
+    groupingIdentity = FlagField({3: 1 << 5, 4: 1 << 6}) # k, h
+    unsynchronisation = FlagField({4: 1 << 1}) # n
+    dataLengthIndicator = FlagField({4: 1 << 0}) # p
+
     def __init__(self,
                  versionX,
                  versionMajor,
@@ -730,15 +1861,20 @@ class Frame(object):
                  data=None,
                  rawData=None,
                  **kwargs):
+        # (buffer, offset, size, source, sourceOffset, diagnose) of the payload not decoded yet
+        self.pending = None
+        # payload after the data length indicator flag, written back as is, when it failed to decompress
+        self.undecoded = None
+
         self.versionX = versionX
         self.versionMajor = versionMajor
 
         assert not (frameID is None and frameIDHuman is None)
 
         if frameID is None:
-            frameID = getByValue(frameIDHuman, IDS)
+            frameID = IDS_HUMAN.get(frameIDHuman)
         else:
-            frameIDHuman = IDS[frameID]
+            frameIDHuman = IDS.get(frameID)
 
         if frameID is None:
             msg = 'get frame by ID in human -%s- failed' % frameIDHuman
@@ -749,49 +1885,68 @@ class Frame(object):
         assert Frame.validID(self.id)
         self.frameIDHuman = frameIDHuman
 
-        self.flags = flags
-
-        if self.versionX == 2 and versionMajor == 3:
-            # for v2.3.0, %abc00000 %ijk00000
-
-            ## Frame status flags
-            self.tagAlterPreservation = False # a
-            self.fileAlterPreservation = False # b
-            self.readonly = False # c
-
-            ## Frame format flags
-            self.compression = False # i
-            self.encryption = False # j
-            self.groupingIdentity = False # k
-
-        elif self.versionX == 2 and versionMajor == 4:
-            # for v2.4.0, %0abc0000 %0h00kmnp
-
-            ## Frame status flags
-            self.tagAlterPreservation = False  # a
-            self.fileAlterPreservation = False  # b
-            self.readonly = False  # c
-
-            ## Frame format flags
-            self.groupingIdentity = False  # h
-
-            self.compression = False  # k
-            self.encryption = False  # m
-            self.unsynchronisation = False # n
-            self.dataLengthIndicator = False # p
-
+        # frame flags as in the frame header, see FlagField
+        self.flags = flags or 0
 
         self.data = data
         self.rawData = rawData
 
-        if self.flags is not None:
-            self.parseFlags()
-
         if rawData is not None:
             self.parseRawData(rawData=rawData)
 
     def __str__(self):
-        raise NotImplemented
+        return self.dumps()
+
+    def dumps(self, versionMajor=None):
+        """ frame header and payload for a tag of versionMajor, the frame's own by default """
+        raise NotImplementedError
+
+    def toV2(self, versionMajor):
+        """ copy of a v1 frame for a v2 tag with text in UTF-16 or UTF-8, None when empty """
+        if self.data is None or self.data == '':
+            return None
+
+        frame = copy.copy(self)
+        frame.versionX = 2
+        frame.versionMajor = versionMajor
+        if isinstance(frame, FrameText):
+            frame.encoding = 'UTF-16' if versionMajor == 3 else 'UTF-8'
+        return frame
+
+    def pack(self, payload, versionMajor=None):
+        """
+        frame header followed by payload, compressed by Frame.COMPRESS_POLICY,
+        for a tag of versionMajor, the frame's own by default
+        """
+        versionMajor = versionMajor or self.versionMajor
+        flags = 0
+
+        policy = Frame.COMPRESS_POLICY
+        if policy is not None and self.versionX == 2 and policy(self, len(payload)):
+            dataLength = len(payload)
+            flags = Frame.compression.masks[versionMajor]
+            if versionMajor >= 4:
+                flags |= Frame.dataLengthIndicator.masks[versionMajor]
+                dataLength = Tag.syncsafeEncode(dataLength)
+            payload = struct.pack("!L", dataLength) + zlib.compress(payload)
+
+        size = len(payload)
+        if versionMajor >= 4:
+            size = Tag.syncsafeEncode(size)
+        return self.id + struct.pack("!LH", size, flags) + payload
+
+    def dumpsUndecoded(self, versionMajor=None):
+        """ frame header and the payload kept undecoded, None for a tag of another versionMajor """
+        versionMajor = versionMajor or self.versionMajor
+        if versionMajor != self.versionMajor:
+            return None
+
+        # payload is kept after unsynchronisation decode
+        flags = self.flags & ~Frame.unsynchronisation.masks.get(versionMajor, 0)
+        size = len(self.undecoded)
+        if versionMajor >= 4:
+            size = Tag.syncsafeEncode(size)
+        return self.id + struct.pack("!LH", size, flags) + self.undecoded
 
     @property
     def isExperimental(self):
@@ -806,49 +1961,118 @@ class Frame(object):
         return True
 
     def parseFlags(self):
-        if self.flags is not None:
-            if self.versionMajor == 2:
-                if self.versionMajor == 3:
-                    # %abc00000 %ijk00000
-                    if self.flags & (1 << (7 + 8)):
-                        self.tagAlterPreservation = True
-                    if self.flags & (1 << (6 + 8)):
-                        self.fileAlterPreservation = True
-                    if self.flags & (1 << (5 + 8)):
-                        self.readonly = True
-
-                    if self.flags & (1 << 7):
-                        self.readonly = True
-                    if self.flags & (1 << 6):
-                        self.compression = True
-
-                    if self.flags & (1 << 5):
-                        self.encryption = True
-
-                elif self.versionMajor == 4:
-                    # %0abc0000 %0h00kmnp
-                    if self.flags & (1 << (6 + 8)):
-                        self.tagAlterPreservation = True
-                    if self.flags & (1 << (5 + 8)):
-                        self.fileAlterPreservation = True
-                    if self.flags & (1 << (4 + 8)):
-                        self.readonly = True
-
-                    if self.flags & (1 << 6):
-                        self.groupingIdentity = True
-
-                    if self.flags & (1 << 4):
-                        self.compression = True
-                    if self.flags & (1 << 3):
-                        self.encryption = True
-                    if self.flags & (1 << 2):
-                        self.unsynchronisation = True
-                    if self.flags & (1 << 1):
-                        self.dataLengthIndicator = True
+        # flags are read from self.flags on access by FlagField
+        pass
 
     def parseRawData(self, rawData):
         raise NotImplementedError
 
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "data": jsonValue(self.data),
+        }
+
+    def estimateSize(self):
+        """ approximate bytes held by frame and its string attributes """
+        size = sys.getsizeof(self)
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                value = getattr(self, name, None)
+                if isinstance(value, basestring):
+                    size += sys.getsizeof(value)
+        return size
+
+    @staticmethod
+    def unsyncPacked(rawFrame):
+        """ v2.4 packed frame with its payload unsynchronised and flag n set """
+        frameID, size, flags = struct.unpack_from("!4sLH", rawFrame)
+        payload = Tag.unsyncEncode(rawFrame[Tag.HEADER_SIZE:])
+        flags |= Frame.unsynchronisation.masks[4]
+        return struct.pack("!4sLH", frameID, Tag.syncsafeEncode(len(payload)), flags) + payload
+
+    def parseBuffer(self, buf, offset, size, source=None, sourceOffset=0):
+        """
+        Parse payload buf[offset:offset+size], buf[0] is at sourceOffset
+        of source (file path) when known.
+        """
+        self.parseRawData(rawData=sliceBytes(buf, offset, offset + size))
+
+    def setPending(self, buf, offset, size, source=None, sourceOffset=0, diagnose=None):
+        self.pending = (buf, offset, size, source, sourceOffset, diagnose)
+
+    def __getstate__(self):
+        """ slot values with the pending payload decoded, a memoryview or mmap does not unpickle """
+        if self.pending is not None:
+            self.decodePending()
+
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return None, state
+
+    def decodeBuffer(self, buf, offset, size, source=None, sourceOffset=0, diagnose=None):
+        """
+        parseBuffer on payload after the data length indicator, decompressed
+        if needed, timed into decode.<class> when stats are enabled.
+        A payload which fails to decompress is kept in undecoded and
+        reported to diagnose(code, frameID=, detail=), Tag.diagnose
+        bound to the frame offset.
+        """
+        if self.flags and self.versionX == 2 and self.unsynchronisation:
+            # v2.4 only, data length indicator is syncsafe so not touched by unsynchronisation
+            buf = Tag.unsyncDecode(sliceBytes(buf, offset, offset + size))
+            offset, size, source, sourceOffset = 0, len(buf), None, 0
+
+        if self.flags and self.versionX == 2 and (
+                (self.versionMajor == 3 and self.compression) or self.dataLengthIndicator):
+            if size < 4:
+                msg = 'frame %s too short for its data length indicator'
+                logger.warn(msg, self.id)
+                return
+
+            dataLength = struct.unpack_from("!L", buf, offset)[0]
+            if self.versionMajor >= 4:
+                dataLength = Tag.syncsafeDecode(dataLength)
+            offset += 4
+            size -= 4
+
+            if self.compression:
+                error = None
+                if dataLength > Frame.MAX_DECOMPRESSED_SIZE:
+                    error = 'decompressed size %d over %d' % (dataLength, Frame.MAX_DECOMPRESSED_SIZE)
+                else:
+                    try:
+                        inflated = inflateRange(buf, offset, size, limit=dataLength)
+                    except zlib.error as e:
+                        error = str(e)
+
+                if error is not None:
+                    self.undecoded = sliceBytes(buf, offset - 4, offset + size)
+                    if diagnose is not None:
+                        diagnose("decompress-failed", frameID=self.id, detail=error)
+                    return
+                buf = inflated
+                offset, size, source, sourceOffset = 0, len(buf), None, 0
+
+        stats = STATS
+        if stats is None:
+            return self.parseBuffer(buf=buf, offset=offset, size=size, source=source, sourceOffset=sourceOffset)
+
+        started = timeit.default_timer()
+        try:
+            return self.parseBuffer(buf=buf, offset=offset, size=size, source=source, sourceOffset=sourceOffset)
+        finally:
+            stats.addTime('decode.' + type(self).__name__, timeit.default_timer() - started)
+
+    def decodePending(self):
+        buf, offset, size, source, sourceOffset, diagnose = self.pending
+        self.pending = None
+        self.decodeBuffer(buf=buf, offset=offset, size=size, source=source, sourceOffset=sourceOffset,
+                          diagnose=diagnose)
+
 
     def update(self, rawData=None, data=None):
         kwargs = dict()
@@ -922,6 +2146,12 @@ class Frame(object):
 
 class FrameText(Frame):
 
+    __slots__ = ('_encoding', '_moreValues')
+
+    encoding = LazyField("encoding")
+    # values after data in a v2.4 multi-value frame, None for single value
+    moreValues = LazyField("moreValues")
+
     def __init__(self, encoding=None,  **kwargs):
         super(FrameText, self).__init__(**kwargs)
 
@@ -937,27 +2167,42 @@ class FrameText(Frame):
 
         self.encoding = encoding
 
-    def __str__(self):
-        chunks = [self.id]
+    @property
+    def values(self):
+        """ all values of the frame, data is the first one """
+        if self.data is None:
+            return []
+        return [self.data] + list(self.moreValues or ())
+
+    @values.setter
+    def values(self, values):
+        values = list(values)
+        self.data = values[0] if values else None
+        self.moreValues = values[1:] or None
+
+    def update(self, rawData=None, data=None):
+        super(FrameText, self).update(rawData=rawData, data=data)
+        if data is not None:
+            self.moreValues = None
+
+    def dumps(self, versionMajor=None):
+        versionMajor = versionMajor or self.versionMajor
 
         segments = []
         encoding = ENCODINGS.index(self.encoding)
         segments.append(chr(encoding))
 
-        dataU = HelperString.to_uni(self.data) + '\x00'
-        dataDecoded = dataU.encode(self.encoding)
-        segments.append(dataDecoded)
-        dataB = ''.join(segments)
-
-        size = len(dataB)
-        chunks.append(struct.pack("!L", size))
+        values = [HelperString.to_uni(value) for value in self.values] or [u'']
+        if versionMajor < 4:
+            # several values are separated by "/" before v2.4
+            values = [u'/'.join(values)]
 
-        flags = 0
-        chunks.append(struct.pack("!H", flags))
-
-        chunks.append(dataB)
+        for value in values:
+            # each value encoded on its own, so UTF-16 values all have a BOM
+            segments.append((value + u'\x00').encode(self.encoding))
+        dataB = ''.join(segments)
 
-        return ''.join(chunks)
+        return self.pack(dataB, versionMajor)
 
     def parseRawData(self, rawData):
         self.rawData = rawData
@@ -975,16 +2220,45 @@ class FrameText(Frame):
                 return
 
             self.encoding = ENCODINGS[idx]
-            self.data = remain.decode(self.encoding).strip(' \x00')
+            if self.versionMajor < 4:
+                self.data = remain.decode(self.encoding).strip(' \x00')
+                return
+
+            values = [piece.decode(self.encoding).strip(' \x00') for piece in splitValues(remain, self.encoding)]
+            while len(values) > 1 and not values[-1]:
+                values.pop()
+
+            self.data = values[0] if values else u''
+            self.moreValues = values[1:] or None
+
+    def toDict(self):
+        d = super(FrameText, self).toDict()
+        if self.moreValues:
+            d["values"] = [jsonValue(value) for value in self.values]
+        return d
 
 
 class FramePrivate(Frame):
+
+    __slots__ = ('_ownerIdentifier', )
+
+    ownerIdentifier = LazyField("ownerIdentifier")
+
     def __init__(self, ownerIdentifier=None, privateData=None, **kwargs):
         super(FramePrivate, self).__init__(**kwargs)
 
         self.ownerIdentifier = ownerIdentifier
         self.data = privateData
 
+    def dumps(self, versionMajor=None):
+        segments = []
+        segments.append(HelperString.to_str(self.ownerIdentifier or '') + '\x00')
+        segments.append(self.data or '')
+
+        dataB = ''.join(segments)
+
+        return self.pack(dataB, versionMajor)
+
     def parseRawData(self, rawData):
         self.rawData = rawData
 
@@ -1002,9 +2276,21 @@ class FramePrivate(Frame):
     def privateData(self):
         return self.data
 
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "owner": jsonValue(self.ownerIdentifier),
+            "size": len(self.data or ''),
+        }
+
 
 
 class FrameUserDefinedTextInformation(FrameText):
+
+    __slots__ = ('_description', )
+
+    description = LazyField("description")
+
     def __init__(self, description="\x00", **kwargs):
         kwargs['frameID'] = "TXXX"
         super(FrameUserDefinedTextInformation, self).__init__(**kwargs)
@@ -1012,9 +2298,7 @@ class FrameUserDefinedTextInformation(FrameText):
         self.data = None
 
 
-    def __str__(self):
-        chunks = [self.id]
-
+    def dumps(self, versionMajor=None):
         segments = []
         encoding = ENCODINGS.index(self.encoding)
         segments.append(chr(encoding))
@@ -1029,15 +2313,7 @@ class FrameUserDefinedTextInformation(FrameText):
 
         dataB = ''.join(segments)
 
-        size = len(dataB)
-        chunks.append(struct.pack("!L", size))
-
-        flags = 0
-        chunks.append(struct.pack("!H", flags))
-
-        chunks.append(dataB)
-
-        return ''.join(chunks)
+        return self.pack(dataB, versionMajor)
 
 
     def parseRawData(self, rawData):
@@ -1056,14 +2332,7 @@ class FrameUserDefinedTextInformation(FrameText):
 
         self.encoding = ENCODINGS[idx]
 
-        if self.encoding == 'UTF-16':
-            spliter = '\x00\x00'
-        else:
-            spliter = '\x00'
-
-        idx = remain.index(spliter)
-        description = remain[:idx+1] # encoding with one char $00, so we do plus here
-        remain = remain[idx+len(spliter)+1:]
+        description, remain = splitTerminated(remain, self.encoding)
 
         self.description = description.decode(self.encoding).strip(' \x00')
 
@@ -1074,8 +2343,130 @@ class FrameUserDefinedTextInformation(FrameText):
     def value(self):
         return self.data
 
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "description": jsonValue(self.description),
+            "data": jsonValue(self.data),
+        }
+
+
+class Picture(object):
+    """
+    Attached picture payload located by (filepath or buf, offset, length),
+    bytes are read on demand only.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, offset, length, filepath=None, buf=None, mimeType=None, pictureType=None):
+        assert not (filepath is None and buf is None)
+
+        self.filepath = filepath
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+        self.mimeType = mimeType
+        self.pictureType = pictureType
+
+    def __len__(self):
+        return self.length
+
+    def detach(self):
+        """ copy picture bytes out of buf, e.g. a mmap about to be closed """
+        if self.buf is not None:
+            self.buf = sliceBytes(self.buf, self.offset, self.offset + self.length)
+            self.offset = 0
+
+    def __getstate__(self):
+        """ buf is pickled as the picture bytes, a memoryview or mmap does not unpickle """
+        state = self.__dict__.copy()
+        if self.buf is not None:
+            state["buf"] = sliceBytes(self.buf, self.offset, self.offset + self.length)
+            state["offset"] = 0
+        return state
+
+    def open(self):
+        return PictureReader(picture=self)
+
+    def read(self):
+        with self.open() as reader:
+            return reader.read()
+
+    def sha1(self, chunkSize=CHUNK_SIZE):
+        """ hex digest of picture bytes, read in chunks """
+        digest = hashlib.sha1()
+        with self.open() as reader:
+            while True:
+                chunk = reader.read(chunkSize)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def readInto(self, fileobj, chunkSize=CHUNK_SIZE):
+        """ stream picture bytes into fileobj, returns bytes written """
+        written = 0
+        with self.open() as reader:
+            while True:
+                chunk = reader.read(chunkSize)
+                if not chunk:
+                    break
+                fileobj.write(chunk)
+                written += len(chunk)
+        return written
+
+
+class PictureReader(object):
+    """ File-like reader over a Picture """
+
+    def __init__(self, picture):
+        self.picture = picture
+        self.position = 0
+
+        self.fileobj = None
+        if picture.filepath is not None:
+            self.fileobj = openCounted(picture.filepath)
+            self.fileobj.seek(picture.offset, os.SEEK_SET)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, size=-1):
+        remain = self.picture.length - self.position
+        if size < 0 or size > remain:
+            size = remain
+
+        if self.fileobj is not None:
+            chunk = self.fileobj.read(size)
+        else:
+            start = self.picture.offset + self.position
+            chunk = sliceBytes(self.picture.buf, start, start + size)
+
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+
 
 class FrameAttachedPicture(FrameText):
+
+    __slots__ = ('_mimeType', '_pictureType', '_description', '_picture')
+
+    mimeType = LazyField("mimeType")
+    pictureType = LazyField("pictureType")
+    description = LazyField("description")
+    picture = LazyField("picture")
+
+    # bytes sliced out at first to find mime type and description
+    HEAD_SIZE = 512
+
     def __init__(self, mimeType=None, pictureType=None, description=None, **kwargs):
         kwargs['frameID'] = "APIC"
         super(FrameAttachedPicture, self).__init__(**kwargs)
@@ -1083,62 +2474,150 @@ class FrameAttachedPicture(FrameText):
         self.pictureType = pictureType
         self.description = description
 
+    @property
+    def data(self):
+        picture = self.picture
+        if picture is None:
+            return
+        return picture.read()
+
+    @data.setter
+    def data(self, value):
+        if value is None:
+            self.picture = None
+        else:
+            self.picture = Picture(buf=value, offset=0, length=len(value))
+
     @property
     def pictureData(self):
         return self.data
 
+    def estimateSize(self):
+        size = super(FrameAttachedPicture, self).estimateSize()
+        if self.picture is not None:
+            size += len(self.picture)
+        return size
+
+    def toDict(self):
+        picture = self.picture
+        return {
+            "name": self.frameIDHuman,
+            "mimeType": jsonValue(self.mimeType),
+            "pictureType": self.pictureType,
+            "description": jsonValue(self.description),
+            "size": len(picture) if picture is not None else 0,
+            "sha1": picture.sha1() if picture is not None else None,
+        }
+
+    def dumps(self, versionMajor=None):
+        segments = []
+        encoding = ENCODINGS.index(self.encoding)
+        segments.append(chr(encoding))
+
+        segments.append(HelperString.to_str(self.mimeType or '') + '\x00')
+        segments.append(chr(self.pictureType or 0))
+
+        descriptionU = HelperString.to_uni(self.description or u'') + u'\x00'
+        segments.append(descriptionU.encode(self.encoding))
+
+        segments.append(self.data or '')
+
+        dataB = ''.join(segments)
+
+        return self.pack(dataB, versionMajor)
+
     def parseRawData(self, rawData):
+        self.parseBuffer(buf=rawData, offset=0, size=len(rawData))
+
+    def parseBuffer(self, buf, offset, size, source=None, sourceOffset=0):
+        """
+        Only the picture header is sliced out of buf, picture bytes are
+        referred by a Picture on source (file path) or buf.
+        """
         if self.versionX != 2:
             msg = 'only tag v2.3.0+ support APIC frame'
             logger.warn(msg)
             return
 
-        self.rawData = rawData
+        head = sliceBytes(buf, offset, offset + min(size, self.HEAD_SIZE))
+        try:
+            headSize = self.parsePictureHeader(head)
+        except ValueError:
+            head = sliceBytes(buf, offset, offset + size)
+            headSize = self.parsePictureHeader(head)
 
-        idx = ord(rawData[0])
-        remain = rawData[1:]
+        if headSize is None:
+            return
 
-        if idx < 0 or idx > len(ENCODINGS):
+        length = max(size - headSize, 0)
+        if source is not None:
+            self.picture = Picture(filepath=source, offset=sourceOffset + offset + headSize, length=length,
+                                   mimeType=self.mimeType, pictureType=self.pictureType)
+        else:
+            self.picture = Picture(buf=buf, offset=offset + headSize, length=length,
+                                   mimeType=self.mimeType, pictureType=self.pictureType)
+
+    def parsePictureHeader(self, head):
+        """ returns size of $encoding, mime type, picture type and description, raises ValueError if head is short """
+        idx = ord(head[0])
+        if idx >= len(ENCODINGS):
             msg = 'encoding not support'
             logger.warn(msg)
             return
 
         self.encoding = ENCODINGS[idx]
 
-        if self.encoding == 'UTF-8':
-            offset = 1
+        pos = 1
+        idx = head.index('\x00', pos)
+        mimeType = head[pos:idx]
+        pos = idx + 1
+
+        if pos >= len(head):
+            raise ValueError('picture type out of range')
+        pictureType = ord(head[pos])
+        pos += 1
+
+        if self.encoding in ['UTF-16', 'UTF-16BE']:
+            idx = head.index('\x00\x00', pos)
+            while (idx - pos) % 2:
+                idx = head.index('\x00\x00', idx + 1)
+            spliter = 2
         else:
-            offset = 2
+            idx = head.index('\x00', pos)
+            spliter = 1
+        description = head[pos:idx]
+        pos = idx + spliter
 
-        idx = remain.index('\x00')
-        mimeType = remain[:idx]
-        remain = remain[idx + 1:]
         self.mimeType = mimeType
-
-        pictureType = ord(remain[0])
-        remain = remain[1:]
         self.pictureType = pictureType
+        self.description = description.decode(self.encoding).strip(u' \x00\ufeff')
 
-        idx = remain.index('\x00')
-        description = remain[:idx]
-        remain = remain[idx + offset:]
-        self.description = description.decode(self.encoding).strip(' \x00')
-
-        self.data = remain
+        return pos
 
 
 class FrameComment(FrameText):
+
+    __slots__ = ('_language', '_shortDescription')
+
+    language = LazyField("language")
+    shortDescription = LazyField("shortDescription")
+
     def __init__(self, language="eng", shortDescription="\x00", **kwargs):
         kwargs['frameID'] = "COMM"
         super(FrameComment, self).__init__(**kwargs)
         self.language = language
         self.shortDescription = shortDescription
 
-
-    def __str__(self):
-        chunks = [self.id]
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "language": jsonValue(self.language),
+            "description": jsonValue(self.shortDescription),
+            "data": jsonValue(self.data),
+        }
 
 
+    def dumps(self, versionMajor=None):
         segments = []
 
         encoding = ENCODINGS.index(self.encoding)
@@ -1156,15 +2635,7 @@ class FrameComment(FrameText):
         dataB = ''.join(segments)
 
 
-        size = len(dataB)
-        chunks.append(struct.pack("!L", size))
-
-        flags = 0
-        chunks.append(struct.pack("!H", flags))
-
-        chunks.append(dataB)
-
-        return ''.join(chunks)
+        return self.pack(dataB, versionMajor)
 
 
     def parseRawData(self, rawData):
@@ -1185,36 +2656,45 @@ class FrameComment(FrameText):
             encoding = ENCODINGS[idx]
             self.encoding = encoding
 
-            if encoding == 'UTF-8':
-                offset = 1
-            else:
-                offset = 2
-
             language = remain[:3]
             remain = remain[3:]
             if len(language) != 3:
-                msg = 'got comment in unexpected structure %s' % repr(rawData)
-                logger.warn(msg)
+                msg = 'got comment in unexpected structure %r'
+                logger.warn(msg, rawData)
                 return
 
             self.language = language
 
-            idx = remain.index('\x00')
-            shortDescription = remain[:idx]
-            remain = remain[idx + offset:]
+            shortDescription, remain = splitTerminated(remain, self.encoding)
             self.shortDescription = shortDescription.decode(self.encoding).strip(' \x00')
 
             self.data = remain.decode(self.encoding).strip(' \x00')
 
 
 class FrameURLLink(FrameText):
+
+    __slots__ = ('_description', )
+
+    description = LazyField("description")
+
     def __init__(self, description="\x00", **kwargs):
         super(FrameURLLink, self).__init__(**kwargs)
 
+        if self.id != "WXXX":
+            # only WXXX has $encoding and description, other W frames are the URL alone
+            description = None
         self.description = description
 
-    def __str__(self):
-        chunks = [self.id]
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "description": jsonValue(self.description),
+            "data": jsonValue(self.data),
+        }
+
+    def dumps(self, versionMajor=None):
+        if self.id != "WXXX":
+            return self.pack(HelperString.to_uni(self.data or u'').encode('ISO8859-1'), versionMajor)
 
         segments = []
 
@@ -1232,15 +2712,7 @@ class FrameURLLink(FrameText):
         dataB = ''.join(segments)
 
 
-        size = len(dataB)
-        chunks.append(struct.pack("!L", size))
-
-        flags = 0
-        chunks.append(struct.pack("!H", flags))
-
-        chunks.append(dataB)
-
-        return ''.join(chunks)
+        return self.pack(dataB, versionMajor)
 
 
     def parseRawData(self, rawData):
@@ -1249,6 +2721,10 @@ class FrameURLLink(FrameText):
         if self.versionX != 2:
             return
 
+        if self.id != "WXXX":
+            self.description = None
+            self.data = rawData.decode('ISO8859-1').strip('\x00')
+            return
 
         idx = ord(rawData[0])
         remain = rawData[1:]
@@ -1261,14 +2737,7 @@ class FrameURLLink(FrameText):
         encoding = ENCODINGS[idx]
         self.encoding = encoding
 
-        if encoding == 'UTF-8':
-            offset = 1
-        else:
-            offset = 2
-
-        idx = remain.index('\x00')
-        description = remain[:idx]
-        remain = remain[idx + offset:]
+        description, remain = splitTerminated(remain, self.encoding)
         self.description = description.decode(self.encoding).strip(' \x00')
 
         self.data = remain.decode(self.encoding)
@@ -1276,6 +2745,12 @@ class FrameURLLink(FrameText):
 
 class SynchronisedLyrics(Frame):
 
+    __slots__ = ('_encoding', '_language', '_contentDescriptor')
+
+    encoding = LazyField("encoding")
+    language = LazyField("language")
+    contentDescriptor = LazyField("contentDescriptor")
+
     def __init__(self, language="eng", contentDescriptor="\x00", **kwargs):
         kwargs['frameID'] = "USLT"
         super(SynchronisedLyrics, self).__init__(**kwargs)
@@ -1287,6 +2762,36 @@ class SynchronisedLyrics(Frame):
     def lyrics(self):
         return self.data
 
+    def dumps(self, versionMajor=None):
+        versionMajor = versionMajor or self.versionMajor
+
+        encoding = self.encoding
+        if encoding is None:
+            encoding = 'UTF-16' if versionMajor == 3 else 'UTF-8'
+
+        segments = []
+        segments.append(chr(ENCODINGS.index(encoding)))
+
+        segments.append(self.language)
+
+        contentDescriptorU = HelperString.to_uni(self.contentDescriptor) + u'\x00'
+        segments.append(contentDescriptorU.encode(encoding))
+
+        dataDecoded = HelperString.to_uni(self.data or u'').encode(encoding)
+        segments.append(dataDecoded)
+
+        dataB = ''.join(segments)
+
+        return self.pack(dataB, versionMajor)
+
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "language": jsonValue(self.language),
+            "description": jsonValue(self.contentDescriptor),
+            "data": jsonValue(self.data),
+        }
+
     def parseRawData(self, rawData):
         self.rawData = rawData
 
@@ -1297,45 +2802,735 @@ class SynchronisedLyrics(Frame):
         remain = rawData[1:]
 
         if idx < 0 or idx > len(ENCODINGS):
-            msg = 'got unexpected encoding %s' % repr(idx)
-            logger.warn(msg)
+            msg = 'got unexpected encoding %r'
+            logger.warn(msg, idx)
             return
 
         encoding = ENCODINGS[idx]
         self.encoding = encoding
 
-        if encoding == 'UTF-8':
-            offset = 1
-        else:
-            offset = 2
-
-
         language = remain[:3]
         remain = remain[3:]
         if len(language) != 3:
-            msg = 'got comment in unexpected structure %s' % repr(rawData)
-            logger.warn(msg)
+            msg = 'got comment in unexpected structure %r'
+            logger.warn(msg, rawData)
             return
 
         self.language = language
 
-        idx = remain.index('\x00')
-        contentDescriptor = remain[:idx]
-        remain = remain[idx + offset:]
+        contentDescriptor, remain = splitTerminated(remain, self.encoding)
         self.contentDescriptor = contentDescriptor.decode(self.encoding).strip(' \x00')
 
         self.data = remain.decode(self.encoding).strip(' \x00')
 
 
+class FrameUnknown(Frame):
+    """ Frame of an ID without registered class, payload is kept as is and written back unchanged """
+
+    __slots__ = ()
+
+    def dumps(self, versionMajor=None):
+        return self.pack(self.data or '', versionMajor)
+
+    def parseRawData(self, rawData):
+        self.rawData = rawData
+        self.data = rawData
+
+    def toDict(self):
+        return {
+            "name": self.frameIDHuman,
+            "size": len(self.data or ''),
+        }
+
+
+# frame ID -> frame class
+FRAME_CLASSES = {}
+# first character of frame ID -> frame class, for IDs not in FRAME_CLASSES
+FRAME_CLASS_PREFIXES = {}
+# frame ID -> frame class resolved by Tag.frameClass
+FRAME_CLASS_CACHE = {}
+
+
+def registerFrameClass(clsFrame, frameIDs=(), prefix=None):
+    """
+    Parse frames of frameIDs, or of IDs starting with the prefix
+    character, with clsFrame, a Frame subclass. Frames of other IDs
+    are FrameUnknown.
+    """
+    for frameID in frameIDs:
+        FRAME_CLASSES[frameID] = clsFrame
+    if prefix is not None:
+        FRAME_CLASS_PREFIXES[prefix] = clsFrame
+    FRAME_CLASS_CACHE.clear()
+
+
+registerFrameClass(FrameText, prefix="T")
+registerFrameClass(FrameURLLink, prefix="W")
+registerFrameClass(FrameUserDefinedTextInformation, ["TXXX"])
+registerFrameClass(FrameComment, ["COMM"])
+registerFrameClass(FrameAttachedPicture, ["APIC"])
+registerFrameClass(FramePrivate, ["PRIV"])
+registerFrameClass(SynchronisedLyrics, ["USLT"])
+
+
+class TagCache(object):
+    """
+    Persistent cache of parsed tags in SQLite, keyed by (device, inode)
+    of the file and valid while its size and mtime are unchanged.
+    Least recently used entries are evicted over maxBytes.
+
+    Tags are stored without rawData, pictures keep referring to the file.
+    """
+
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    # bump when pickled Tag, Frame or Picture change, older caches are emptied on open
+    FORMAT_VERSION = 1
+
+    def __init__(self, filepath, maxBytes=DEFAULT_MAX_BYTES, commitEvery=1000, readonly=False):
+        self.filepath = filepath
+        self.maxBytes = maxBytes
+        self.commitEvery = commitEvery
+        self.readonly = readonly
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.connection = sqlite3.connect(filepath, timeout=60)
+        self.connection.text_factory = str
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+
+        # False for a cache of another format, read only caches then only miss
+        self.compatible = self.connection.execute("PRAGMA user_version").fetchone()[0] == TagCache.FORMAT_VERSION
+
+        if not readonly:
+            if not self.compatible:
+                self.connection.execute("DROP TABLE IF EXISTS tags")
+                self.connection.execute("PRAGMA user_version = %d" % TagCache.FORMAT_VERSION)
+                self.compatible = True
+
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tags ("
+                " device INTEGER NOT NULL,"
+                " inode INTEGER NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime REAL NOT NULL,"
+                " used INTEGER NOT NULL,"
+                " nbytes INTEGER NOT NULL,"
+                " data BLOB,"
+                " PRIMARY KEY (device, inode))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS tags_used ON tags (used)")
+            self.connection.commit()
+
+        row = self.connection.execute("SELECT COALESCE(MAX(used), 0), COALESCE(SUM(nbytes), 0) FROM tags").fetchone()
+        self.clock, self.residentBytes = row
+
+        self.uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def key(fstat):
+        return fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime
+
+    @staticmethod
+    def dumpsTag(tag):
+        """ pickle a copy of tag with pending frames decoded and no raw data, tag is left as is """
+        if tag is None:
+            return None
+
+        cached = copy.copy(tag)
+        cached.frames = []
+        cached.frameIndex = {}
+        cached.descriptionIndex = None
+        for f in tag.frames:
+            f = copy.copy(f)
+            if f.pending is not None:
+                f.decodePending()
+            f.rawData = None
+            cached.frameAppend(frame=f)
+        return zlib.compress(cPickle.dumps(cached, 2))
+
+    @staticmethod
+    def loadsTag(blob, filepath):
+        if blob is None:
+            return None
+
+        tag = cPickle.loads(zlib.decompress(str(blob)))
+        for f in tag.frames:
+            if f.id == "APIC" and f.picture is not None and f.picture.filepath is not None:
+                # file may have been renamed since cached
+                f.picture.filepath = filepath
+        return tag
+
+    def get(self, filepath, fstat):
+        """ returns (found, tag), tag is None for a cached file without tag """
+        if not self.compatible:
+            self.misses += 1
+            return False, None
+
+        device, inode, size, mtime = TagCache.key(fstat)
+        row = self.connection.execute(
+            "SELECT size, mtime, data FROM tags WHERE device = ? AND inode = ?", (device, inode)
+        ).fetchone()
+
+        if row is None or row[0] != size or row[1] != mtime:
+            self.misses += 1
+            return False, None
+
+        try:
+            tag = TagCache.loadsTag(row[2], filepath)
+        except Exception as e:
+            # a miss, the caller parses the file again and overwrites the entry
+            msg = 'cached tag of %s not loaded, %s: %s' % (filepath, type(e).__name__, e)
+            logger.warn(msg)
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        if not self.readonly:
+            self.touch(key=TagCache.key(fstat))
+        return True, tag
+
+    def touch(self, key):
+        """ mark entry as recently used """
+        device, inode, size, mtime = key
+        self.clock += 1
+        self.connection.execute("UPDATE tags SET used = ? WHERE device = ? AND inode = ?",
+                                (self.clock, device, inode))
+        self.commitMaybe()
+
+    def put(self, fstat, tag):
+        self.putBlob(key=TagCache.key(fstat), blob=TagCache.dumpsTag(tag))
+
+    def putBlob(self, key, blob):
+        device, inode, size, mtime = key
+        nbytes = len(blob) if blob is not None else 0
+
+        row = self.connection.execute(
+            "SELECT nbytes FROM tags WHERE device = ? AND inode = ?", (device, inode)
+        ).fetchone()
+        if row is not None:
+            self.residentBytes -= row[0]
+
+        self.clock += 1
+        self.connection.execute(
+            "INSERT OR REPLACE INTO tags (device, inode, size, mtime, used, nbytes, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (device, inode, size, mtime, self.clock, nbytes, sqlite3.Binary(blob) if blob is not None else None)
+        )
+        self.residentBytes += nbytes
+
+        if self.residentBytes > self.maxBytes:
+            self.evict()
+        self.commitMaybe()
+
+    def evict(self):
+        """ drop least recently used entries until under maxBytes """
+        while self.residentBytes > self.maxBytes:
+            rows = self.connection.execute(
+                "SELECT device, inode, nbytes FROM tags ORDER BY used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+
+            for device, inode, nbytes in rows:
+                self.connection.execute("DELETE FROM tags WHERE device = ? AND inode = ?", (device, inode))
+                self.residentBytes -= nbytes
+                self.evictions += 1
+                if self.residentBytes <= self.maxBytes:
+                    break
+
+    def parseFromFilepath(self, filepath, useMmap=False):
+        fstat = os.stat(filepath)
+
+        found, tag = self.get(filepath=filepath, fstat=fstat)
+        if found:
+            return tag
+
+        tag = Tag.parseFromFilepath(filepath=filepath, useMmap=useMmap)
+        if not self.readonly:
+            self.put(fstat=fstat, tag=tag)
+        return tag
+
+    def commitMaybe(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commitEvery:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        if self.connection is not None:
+            if not self.readonly:
+                self.commit()
+            self.connection.close()
+            self.connection = None
+
+    @property
+    def hitRatio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRatio": self.hitRatio,
+            "residentBytes": self.residentBytes,
+        }
+
+
+class TagMemoryCache(object):
+    """
+    Thread-safe in-process LRU cache of parsed tags, bounded by estimated
+    size of cached tags, entries are validated by os.stat on every hit.
+
+    Cached tags are shared, callers should not modify them.
+    """
+
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, maxBytes=DEFAULT_MAX_BYTES):
+        self.maxBytes = maxBytes
+
+        # filepath -> (stat key, tag, nbytes), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.residentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(fstat):
+        return fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime
+
+    def parseFromFilepath(self, filepath, useMmap=False):
+        fstat = os.stat(filepath)
+        key = TagMemoryCache.key(fstat)
+
+        with self.lock:
+            entry = self.entries.pop(filepath, None)
+            if entry is not None:
+                if entry[0] == key:
+                    self.entries[filepath] = entry
+                    self.hits += 1
+                    return entry[1]
+                self.residentBytes -= entry[2]
+            self.misses += 1
+
+        tag = Tag.parseFromFilepath(filepath=filepath, useMmap=useMmap)
+        nbytes = tag.estimateSize() if tag is not None else 0
+
+        with self.lock:
+            entry = self.entries.pop(filepath, None)
+            if entry is not None:
+                self.residentBytes -= entry[2]
+
+            if nbytes <= self.maxBytes:
+                self.entries[filepath] = (key, tag, nbytes)
+                self.residentBytes += nbytes
+
+            while self.residentBytes > self.maxBytes and self.entries:
+                evicted = self.entries.popitem(last=False)[1]
+                self.residentBytes -= evicted[2]
+                self.evictions += 1
+
+        return tag
+
+    def invalidate(self, filepath):
+        with self.lock:
+            entry = self.entries.pop(filepath, None)
+            if entry is not None:
+                self.residentBytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.residentBytes = 0
+
+    @property
+    def hitRatio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRatio": self.hitRatio,
+                "residentBytes": self.residentBytes,
+            }
+
+
+def defaultThreadPool():
+    global DEFAULT_THREAD_POOL
+    if DEFAULT_THREAD_POOL is None:
+        DEFAULT_THREAD_POOL = multiprocessing.pool.ThreadPool(processes=DEFAULT_CONCURRENCY)
+    return DEFAULT_THREAD_POOL
+
+
+def parseTask(item):
+    """ parse one file for Tag.parseMany, errors are returned instead of raised """
+    filepath, kwargs = item
+    try:
+        return filepath, Tag.parseFromFilepath(filepath=filepath, **kwargs), None
+    except Exception as e:
+        return filepath, None, e
+
+
+def scanFile(item):
+    """
+    parse one file for tagScan, errors are returned instead of raised,
+    output is Tag.pformat() for "text" or Tag.toDict() for "jsonl",
+    diagnostics is Tag.diagnosticCounts().
+
+    With cachePath, tags are looked up in the TagCache and
+    (hit, key, blob) is returned for the caller to touch or store,
+    the caller is the only writer of the cache.
+    """
+    filepath, useMmap, outputFormat, cachePath = item
+    cacheEntry = None
+    try:
+        if cachePath is not None:
+            cache = scanCache(cachePath)
+            fstat = os.stat(filepath)
+            found, tag = cache.get(filepath=filepath, fstat=fstat)
+            if found:
+                cacheEntry = True, TagCache.key(fstat), None
+            else:
+                tag = Tag.parseFromFilepath(filepath=filepath, useMmap=useMmap)
+                cacheEntry = False, TagCache.key(fstat), TagCache.dumpsTag(tag)
+        else:
+            tag = Tag.parseFromFilepath(filepath=filepath, useMmap=useMmap)
+
+        if tag is None:
+            return filepath, None, None, cacheEntry, None
+        if outputFormat == "jsonl":
+            return filepath, tag.toDict(), None, cacheEntry, tag.diagnosticCounts()
+        return filepath, tag.pformat(), None, cacheEntry, tag.diagnosticCounts()
+    except Exception as e:
+        return filepath, None, '%s: %s' % (type(e).__name__, e), None, None
+
+
+# read-only TagCache per process for scanFile
+SCAN_CACHES = {}
+
+
+def scanCache(cachePath):
+    cache = SCAN_CACHES.get(cachePath)
+    if cache is None:
+        cache = TagCache(filepath=cachePath, readonly=True)
+        SCAN_CACHES[cachePath] = cache
+    return cache
+
+
+def scanRecord(filepath, tag=None, error=None):
+    """ JSON Lines record of one file, tag is Tag.toDict() """
+    record = {
+        "filepath": jsonValue(filepath),
+        "tag": tag,
+    }
+    if error is not None:
+        record["error"] = jsonValue(error)
+    return record
+
+
+class JSONLinesWriter(object):
+    """ Write one JSON record per line, flushed as written """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, sort_keys=True)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+
+        self.fileobj.write(line + '\n')
+        self.fileobj.flush()
+        self.count += 1
+
+    def writeMany(self, records):
+        for record in records:
+            self.write(record)
+
+
+def iterFilepaths(dirpath, recursive=False, extensions=None):
+    if recursive:
+        for root, dirnames, filenames in os.walk(dirpath):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if extensions is None or os.path.splitext(filename)[1].lower() in extensions:
+                    yield os.path.join(root, filename)
+    else:
+        for filename in sorted(os.listdir(dirpath)):
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.isfile(filepath):
+                continue
+            if extensions is None or os.path.splitext(filename)[1].lower() in extensions:
+                yield filepath
+
+
+def imapBounded(pool, func, iterable, window, ordered=True):
+    """
+    Like pool.imap but at most window items are submitted and not yet
+    yielded, so iterable is consumed as results are taken.
+    """
+    if ordered:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    else:
+        results = Queue.Queue()
+        inFlight = 0
+        for item in iterable:
+            pool.apply_async(func, (item, ), callback=results.put)
+            inFlight += 1
+            if inFlight >= window:
+                yield results.get()
+                inFlight -= 1
+
+        while inFlight:
+            yield results.get()
+            inFlight -= 1
+
+
+def tagScan(args):
+    dirpath = os.path.realpath(args.dir)
+    extensions = ['.%s' % ext.lower().lstrip('.') for ext in args.ext.split(',')]
+
+    cache = None
+    if args.cache:
+        cache = TagCache(filepath=args.cache, maxBytes=args.cache_max_mb * 1024 * 1024)
+
+    cachePath = args.cache if cache is not None else None
+    items = ((filepath, args.mmap, args.format, cachePath) for filepath in iterFilepaths(
+        dirpath, recursive=args.recursive, extensions=extensions))
+
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = imapBounded(pool, scanFile, items, window=jobs * SCAN_IN_FLIGHT_PER_JOB, ordered=not args.unordered)
+    else:
+        pool = None
+        results = itertools.imap(scanFile, items)
+
+    writer = JSONLinesWriter(fileobj=sys.stdout)
+
+    count, failed = 0, 0
+    diagnostics = collections.Counter()
+    try:
+        for filepath, output, error, cacheEntry, counts in results:
+            count += 1
+            if counts:
+                diagnostics.update(counts)
+
+            if cache is not None and cacheEntry is not None:
+                hit, key, blob = cacheEntry
+                if hit:
+                    cache.hits += 1
+                    cache.touch(key=key)
+                else:
+                    cache.misses += 1
+                    cache.putBlob(key=key, blob=blob)
+
+            if args.format == "jsonl":
+                writer.write(scanRecord(filepath=filepath, tag=output, error=error))
+
+            if error is not None:
+                failed += 1
+                msg = 'FAIL %s %s' % (filepath, error)
+                logger.warn(msg)
+                continue
+
+            if output is None:
+                msg = 'tag not found %s' % filepath
+                logger.debug(msg)
+                continue
+
+            if args.format == "jsonl":
+                continue
+
+            sys.stdout.write(('%s\n%s\n' % (HelperString.to_uni(filepath), output)).encode('utf-8'))
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.close()
+
+    msg = 'SCAN %d files, %d failed' % (count, failed)
+    logger.debug(msg)
+
+    if diagnostics:
+        msg = 'DIAGNOSTICS %s' % json.dumps(diagnostics, sort_keys=True)
+        logger.info(msg)
+
+    if cache is not None:
+        msg = 'CACHE %s' % json.dumps(cache.stats(), sort_keys=True)
+        logger.debug(msg)
+
+
+def readManifest(filepath):
+    """
+    Read bulk update manifest, CSV with filepath,field,value columns or
+    JSON Lines of {"filepath", "field", "value"} or {"filepath", "edits"}
+    records, value null removes the field. Returns edits grouped by
+    filepath, in order of first appearance.
+    """
+    grouped = collections.OrderedDict()
+
+    with open(filepath, 'rb') as f:
+        if os.path.splitext(filepath)[1].lower() in ['.jsonl', '.json']:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                edits = grouped.setdefault(record["filepath"], [])
+                if "edits" in record:
+                    edits.extend(sorted(record["edits"].items()))
+                else:
+                    edits.append((record["field"], record["value"]))
+        else:
+            for row in csv.DictReader(f):
+                edits = grouped.setdefault(row["filepath"].decode('utf-8'), [])
+                edits.append((row["field"], row["value"].decode('utf-8')))
+
+    return grouped
+
+
+def retagFile(item):
+    """
+    Apply all edits of one file for tagBulkUpdate and write it once,
+    errors are returned in the result instead of raised.
+    """
+    filepath, edits, dryRun = item
+    result = {
+        "filepath": jsonValue(filepath),
+        "status": None,
+        "changes": [],
+    }
+    try:
+        tag = Tag.parseFromFilepath(filepath=filepath)
+        if tag is None:
+            tag = Tag(versionX=2, versionMajor=3, revision=0)
+
+        changes = tag.applyEdits(edits)
+        result["changes"] = [
+            {"frameID": frameID, "old": jsonValue(old), "new": jsonValue(new)}
+            for frameID, old, new in changes
+        ]
+
+        unsupported = [frameID for frameID, old, new in changes if frameID not in Tag.V1_FRAME_IDS]
+        if tag.versionX == 1 and unsupported:
+            # an ID3v1 tag would drop them silently, the file is left as is
+            result["status"] = "unsupported"
+            result["error"] = jsonValue('not in ID3v1: %s' % ', '.join(unsupported))
+        elif not changes:
+            result["status"] = "unchanged"
+        elif dryRun:
+            result["status"] = "dry-run"
+        else:
+            tag.saveInPlace(filepath=filepath, version=tag.version)
+            result["status"] = "updated"
+    except Exception as e:
+        result["status"] = "failed"
+        result["error"] = jsonValue('%s: %s' % (type(e).__name__, e))
+    return result
+
+
+def tagBulkUpdate(args):
+    grouped = readManifest(args.manifest)
+    items = ((filepath, edits, args.dry_run) for filepath, edits in grouped.iteritems())
+
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = imapBounded(pool, retagFile, items, window=jobs * SCAN_IN_FLIGHT_PER_JOB, ordered=not args.unordered)
+    else:
+        pool = None
+        results = itertools.imap(retagFile, items)
+
+    writer = JSONLinesWriter(fileobj=sys.stdout)
+
+    counts = collections.Counter()
+    try:
+        for result in results:
+            counts[result["status"]] += 1
+            writer.write(result)
+
+            if result["status"] == "failed":
+                msg = 'FAIL %s %s' % (result["filepath"], result["error"])
+                logger.warn(msg)
+            elif result["status"] == "unsupported":
+                msg = 'SKIP %s %s' % (result["filepath"], result["error"])
+                logger.warn(msg)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    msg = 'UPDATE %d files, %s' % (sum(counts.values()), json.dumps(counts, sort_keys=True))
+    logger.debug(msg)
+
+
 def tagRead(args):
     filepath = os.path.realpath(args.file)
 
-    tag = Tag.parseV2FromFile(fileobj=file(filepath, 'rb'))
+    if args.cache:
+        with TagCache(filepath=args.cache, maxBytes=args.cache_max_mb * 1024 * 1024) as cache:
+            tag = cache.parseFromFilepath(filepath=filepath, useMmap=args.mmap)
+
+        if args.format == "jsonl":
+            record = scanRecord(filepath=filepath, tag=tag.toDict() if tag is not None else None)
+            JSONLinesWriter(fileobj=sys.stdout).write(record)
+        elif tag is not None:
+            tag.pprint()
+        return
+
+    if args.format == "jsonl":
+        tag = Tag.parseFromFilepath(filepath=filepath, useMmap=args.mmap)
+        record = scanRecord(filepath=filepath, tag=tag.toDict() if tag is not None else None)
+        JSONLinesWriter(fileobj=sys.stdout).write(record)
+        return
+
+    if args.mmap:
+        tag = Tag.parseFromFilepath(filepath=filepath, useMmap=True)
+        if tag is not None:
+            tag.pprint()
+        else:
+            msg = 'tag not found'
+            logger.debug(msg)
+        return
+
+    tag = Tag.parseV2FromFile(fileobj=openCounted(filepath))
     if tag is not None:
         tag.pprint()
         return
 
-    tag = Tag.parseV1FromFile(fileobj=file(filepath, 'rb'))
+    tag = Tag.parseV1FromFile(fileobj=openCounted(filepath))
     if tag is not None:
         tag.pprint()
         return
@@ -1348,14 +3543,23 @@ def tagRemove(args):
     filepath = os.path.realpath(args.file)
     prefix = os.path.dirname(filepath)
 
-    b = Tag.remove(filepath)
+    if args.in_place:
+        size = Tag.removeInPlace(filepath, shift=args.shift)
+
+        msg = "STRIP %s, %d bytes" % (filepath, size)
+        logger.debug(msg)
+        return
+
+    probe = Tag.probe(filepath)
 
     filename = os.path.basename(filepath)
     fn, ext = os.path.splitext(filename)
 
     filepathNew = os.path.join(prefix, "%s.cleaned%s" % (fn, ext))
-    with open(filepathNew, "wb") as f:
-        f.write(b)
+    with open(filepath, "rb") as fsrc:
+        with open(filepathNew, "wb") as fdst:
+            copyFileRange(fsrc, fdst, offset=probe["audioOffset"],
+                          length=probe["audioEnd"] - probe["audioOffset"])
 
     msg = "SAVE %s" % filepathNew
     logger.debug(msg)
@@ -1438,9 +3642,10 @@ def tagDump(args):
     if Tag.isV2x(fileobj=fileobj, filesize=fstat.st_size):
         rawHeader = fileobj.read(Tag.HEADER_SIZE)
         fileId, versionMajor, revision, flags, size = struct.unpack("!3sBBBL", rawHeader)
+        size = Tag.syncsafeDecode(size)
 
         fileobj.seek(0, os.SEEK_SET)
-        rawTag = fileobj.read(size + 10)
+        rawTag = fileobj.read(size + Tag.HEADER_SIZE)
 
     elif Tag.isV1x(fileobj=fileobj):
         fileobj.seek(-Tag.V1X_SIZE, os.SEEK_END)
@@ -1470,11 +3675,28 @@ if __name__ == '__main__':
     parser.add_argument('--verbose', action="store_true")
 
     parser.add_argument('--file', help='/full/path/to/audio.mp3')
+    parser.add_argument('--dir', help='scan tags of files in directory')
+    parser.add_argument('--recursive', action="store_true", help="scan directory recursively")
+    parser.add_argument('--jobs', type=int, default=0, help="worker processes for --dir, defaults to CPU count")
+    parser.add_argument('--unordered', action="store_true", help="print --dir results as they complete")
+    parser.add_argument('--ext', default="mp3", help="comma separated file extensions for --dir")
+    parser.add_argument('--format', choices=["text", "jsonl"], default="text", help="output format of read tags")
+    parser.add_argument('--cache', help="/path/to/cache.sqlite of parsed tags")
+    parser.add_argument('--cache-max-mb', type=int, default=TagCache.DEFAULT_MAX_BYTES / 1024 / 1024,
+                        help="evict least recently used cached tags over this size")
 
     parser.add_argument('--read', action="store_true", default=True, help="parse and print tag")
     parser.add_argument('--remove', action="store_true", help="remove tag")
+    parser.add_argument('--in-place', action="store_true", help="remove tag from the file itself instead of a .cleaned copy")
+    parser.add_argument('--shift', action="store_true", help="with --in-place, move audio down within the file instead of a temporary copy")
+    parser.add_argument('--mmap', action="store_true", help="parse tag over a memory-mapped file")
+    parser.add_argument('--stats', action="store_true", help="log I/O counters and phase timers of this process on exit")
+    parser.add_argument('--charsets', help="comma separated codecs tried in order for ID3v1 text, e.g. utf-8,gbk,cp1251")
+    parser.add_argument('--detect-charset-v2', action="store_true", help="also redecode v2 text labelled ISO-8859-1 with --charsets")
 
     #parser.add_argument('--update', action="store_true", help="update tag")
+    parser.add_argument('--manifest', help="CSV or JSON Lines of filepath,field,value edits to apply in bulk")
+    parser.add_argument('--dry-run', action="store_true", help="with --manifest, report changes without writing files")
     parser.add_argument('--version', help="generate specify version tag")
     parser.add_argument('--title')
     parser.add_argument('--artist')
@@ -1490,8 +3712,18 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
+    handler = logging.StreamHandler()
+    handler.setFormatter(fmt=logging.Formatter(LOG_FORMAT))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.stats:
+        enableStats()
+        atexit.register(lambda: logger.info('STATS %s' % json.dumps(statsSnapshot(), sort_keys=True)))
+
+    if args.charsets:
+        CHARSETS[:] = args.charsets.split(',')
+    Tag.DETECT_CHARSET_V2 = args.detect_charset_v2
 
     if args.file:
         filepath = os.path.realpath(args.file)
@@ -1506,6 +3738,20 @@ if __name__ == '__main__':
             tagDump(args=args)
         else:
             tagRead(args=args)
+    elif args.dir:
+        if not os.path.isdir(args.dir):
+            msg = '%s not a directory' % args.dir
+            logger.warn(msg)
+            exit(1)
+
+        tagScan(args=args)
+    elif args.manifest:
+        if not os.path.isfile(args.manifest):
+            msg = '%s not exists' % args.manifest
+            logger.warn(msg)
+            exit(1)
+
+        tagBulkUpdate(args=args)
     # elif args.update:
     #     tagUpdate(args=args)
     else: